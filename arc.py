@@ -2,11 +2,24 @@
 """A module that support sub-archive file in Fantasy Life."""
 
 from __future__ import division, print_function, unicode_literals
+import io
 import os
 import sys
 import argparse
+import mmap
+import zlib
 from collections import namedtuple
-from struct import unpack, error as struct_error
+from struct import Struct, unpack, error as struct_error
+try:
+    from . import instrument
+    from .catalog import ARC, open_catalog
+except (ImportError, ValueError): # Run as a script
+    import instrument
+    from catalog import ARC, open_catalog
+
+
+# Python 2 cannot make memoryviews of mmap objects.
+MMAP_VIEWS = sys.version_info[0] >= 3
 
 
 class InvalidFileError(Exception):
@@ -24,11 +37,35 @@ class Arc(object):
         ]
     )
     
-    def __init__(self, path):
+    ENTRY_STRUCT = Struct('<BBH4I')
+
+    def __init__(self, path, use_mmap=False):
+        """Open an archive.
+
+        Params:
+        * `path`: Path to the archive.
+        * `use_mmap`: If True, map the archive into memory. `getdata` then \
+          returns a zero-copy memoryview slice instead of a bytes object. \
+          Ignored on Python 2.
+        """
         self.path = path
+        self.use_mmap = use_mmap and MMAP_VIEWS
         self.file_entries = []
-        
-        file = open(self.path, 'rb')
+        self.buffer = None
+
+        self.file = open(self.path, 'rb')
+        try:
+            self._parse(self.file)
+        except Exception:
+            self.close()
+            raise
+
+    def _parse(self, file):
+        with instrument.stage('arc.parse') as stage:
+            self._parseentries(file)
+            stage.add(rows=len(self.file_entries))
+
+    def _parseentries(self, file):
         magic = file.read(4)
         if magic != Arc.MAGIC:
             raise InvalidFileError('Invalid file.')
@@ -44,18 +81,43 @@ class Arc(object):
         if 0x14 + self.data_length != file_size:
             raise InvalidFileError('Invalid file.')
 
-        file.seek(file_entries_offset, os.SEEK_SET)
-        raw_file_entries = file.read()
-        for offset in range(0, len(raw_file_entries), 0x14):
-            u1, path_length, u2, u3, file_length, path_offset, file_offset = \
-                unpack('<BBH4I', raw_file_entries[offset:offset + 0x14])
-            file.seek(path_offset, os.SEEK_SET)
-            path = file.read(path_length).decode('ascii')
-            entry = Arc.FileEntry(path, u1, u2, u3,
-                                  file_length, path_offset, file_offset)
-            self.file_entries.append(entry)
+        if self.use_mmap:
+            # Slices of the mmap object are copies, so that no buffer is
+            # exported if a malformed entry raises.
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+            for u1, path_length, u2, u3, file_length, path_offset, \
+                    file_offset in _iterentries(
+                        self.buffer[file_entries_offset:]):
+                path = self.buffer[path_offset:path_offset + path_length]
+                self.file_entries.append(Arc.FileEntry(
+                    _decodepath(path), u1, u2, u3,
+                    file_length, path_offset, file_offset))
+        else:
+            file.seek(file_entries_offset, os.SEEK_SET)
+            raw_file_entries = file.read()
+            for u1, path_length, u2, u3, file_length, path_offset, \
+                    file_offset in _iterentries(raw_file_entries):
+                file.seek(path_offset, os.SEEK_SET)
+                path = _decodepath(file.read(path_length))
+                self.file_entries.append(Arc.FileEntry(
+                    path, u1, u2, u3, file_length, path_offset, file_offset))
+
+    def close(self):
+        """Close the archive.
 
-        self.file = file
+        Memoryviews returned by `getdata` in mmap mode must be released \
+        before calling this method.
+        """
+        if self.buffer is not None:
+            self.buffer.close()
+            self.buffer = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
 
     @property
     def file_count(self):
@@ -63,49 +125,498 @@ class Arc(object):
         return len(self.file_entries)
             
     def getdata(self, file_index):
-        """Get data of the file at `file_index`."""
+        """Get data of the file at `file_index`.
+
+        Return a memoryview slice of the mapped archive in mmap mode, or a \
+        bytes object otherwise.
+        """
         entry = self.file_entries[file_index]
-        self.file.seek(entry.file_offset)
-        return self.file.read(entry.file_length)
+        if self.buffer is not None:
+            return memoryview(self.buffer)[
+                entry.file_offset:entry.file_offset + entry.file_length]
+        with instrument.stage('arc.read') as stage:
+            self.file.seek(entry.file_offset)
+            data = self.file.read(entry.file_length)
+            stage.add(bytes=len(data))
+        return data
             
     def getfilepath(self, file_index):
         """Get file path of file at file_index."""
         return self.file_entries[file_index].path
 
+    @staticmethod
+    def open_by_path(index, path):
+        """Return data of the file at internal `path` as a bytes object.
+
+        Only the file data is read: the header of the archive which contains \
+        it is not parsed.
+
+        Params:
+        * `index`: An `ArcIndex` object.
+        * `path`: Internal file path.
+
+        Raise `KeyError` if `path` is not in the index.
+        """
+        location = index.find(path)
+        if location is None:
+            raise KeyError(path)
+        filepath, file_offset, file_length = location
+        with open(filepath, 'rb') as file:
+            file.seek(file_offset)
+            return file.read(file_length)
+
+
+class ArcIndex(object):
+    """Persistent SQLite index of file paths in all archives of a folder."""
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS archives (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS files (
+            path TEXT NOT NULL,
+            archive_id INTEGER NOT NULL,
+            file_offset INTEGER NOT NULL,
+            file_length INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS files_path ON files (path);
+        CREATE INDEX IF NOT EXISTS files_archive_id ON files (archive_id);
+    """
+
+    def __init__(self, path):
+        """Open or create the index at `path`.
+
+        Archive paths are stored relative to the folder containing the index.
+        """
+        import sqlite3
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(ArcIndex.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def update(self, folder):
+        """Index all archives in `folder`.
+
+        Only files whose size or modification time changed since the last \
+        update are parsed again. Files which are not archives are recorded \
+        without any file, so they are skipped next time too. Archives which \
+        no longer exist are removed.
+
+        Return the number of parsed files.
+        """
+        cursor = self.connection.cursor()
+        known = {}
+        for archive_id, relpath, size, mtime in \
+                cursor.execute('SELECT id, path, size, mtime FROM archives'):
+            known[relpath] = (archive_id, size, mtime)
+
+        parsed_count = 0
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if os.path.abspath(filepath) == os.path.abspath(self.path):
+                    continue
+                relpath = os.path.relpath(filepath, self.root) \
+                    .replace(os.sep, '/')
+                stat = os.stat(filepath)
+                if relpath in known:
+                    archive_id, size, mtime = known[relpath]
+                    if size == stat.st_size and mtime == stat.st_mtime:
+                        continue
+                    self._remove(cursor, archive_id)
+
+                cursor.execute(
+                    'INSERT INTO archives (path, size, mtime) VALUES (?, ?, ?)',
+                    (relpath, stat.st_size, stat.st_mtime))
+                archive_id = cursor.lastrowid
+                parsed_count += 1
+                try:
+                    bin = Arc(filepath, use_mmap=True)
+                except (InvalidFileError, TypeError, struct_error):
+                    continue
+                with bin:
+                    cursor.executemany(
+                        'INSERT INTO files VALUES (?, ?, ?, ?)',
+                        ((entry.path, archive_id, entry.file_offset,
+                          entry.file_length) for entry in bin.file_entries))
+
+        for relpath, (archive_id, size, mtime) in known.items():
+            if not os.path.isfile(os.path.join(self.root, relpath)):
+                self._remove(cursor, archive_id)
+        self.connection.commit()
+        return parsed_count
+
+    @staticmethod
+    def _remove(cursor, archive_id):
+        cursor.execute('DELETE FROM files WHERE archive_id = ?',
+                       (archive_id,))
+        cursor.execute('DELETE FROM archives WHERE id = ?', (archive_id,))
+
+    def find(self, path):
+        """Find the file at internal `path`.
+
+        Return a tuple of (archive path, file offset, file length), or None \
+        if `path` is not in the index. If several archives contain `path`, \
+        the first archive in path order wins, then the first entry in it.
+        """
+        row = self.connection.execute(
+            'SELECT archives.path, file_offset, file_length FROM files '
+            'JOIN archives ON archives.id = files.archive_id '
+            'WHERE files.path = ? ORDER BY archives.path, files.rowid LIMIT 1',
+            (path,)).fetchone()
+        if row is None:
+            return None
+        relpath, file_offset, file_length = row
+        return (os.path.join(self.root, relpath.replace('/', os.sep)),
+                file_offset, file_length)
+
+
+CHUNK_SIZE = 0x4000000  # Bytes of file data per extraction task
+BUFFER_SIZE = 0x100000  # Output file buffer size
+
+
+def _iterentries(raw):
+    """Yield unpacked file entries from raw file entry table."""
+    try:
+        return Arc.ENTRY_STRUCT.iter_unpack(raw)
+    except AttributeError:  # Python 2
+        return (Arc.ENTRY_STRUCT.unpack_from(raw, offset)
+                for offset in range(0, len(raw), Arc.ENTRY_STRUCT.size))
+
+
+def _decodepath(path):
+    """Decode an internal file path."""
+    try:
+        return path.decode('ascii')
+    except UnicodeDecodeError:
+        raise InvalidFileError('Invalid file path.')
+
+
+def _release(data):
+    """Release data returned by `Arc.getdata`, if it is a memoryview."""
+    if isinstance(data, memoryview):
+        data.release()
+
+
+def _outpath(outdir, path):
+    return os.path.join(outdir, path.replace('/', os.sep))
 
-def unpack_file(filepath, outdir):
-    """Unpack file in `filepath` to `outdir`."""
-    bin = Arc(filepath)
-    for file_index in range(bin.file_count):
-        outpath = os.path.join(
-            outdir, bin.getfilepath(file_index).replace('/', os.sep))
-        outsubdir = os.path.dirname(outpath)
-        if not os.path.isdir(outsubdir):
-            os.makedirs(outsubdir)
-        print(outpath)
-        with open(outpath, 'wb') as file:
-            file.write(bin.getdata(file_index))
+
+class Manifest(object):
+    """Record of extracted files, used to skip files which did not change.
+
+    Each entry maps an internal file path to a list of [archive path, \
+    file offset, file length, CRC-32 of file data].
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        if os.path.isfile(path):
+            import json
+            with io.open(path, 'r', encoding='utf-8') as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def default_path(outdir):
+        """Return the default manifest path of `outdir`."""
+        return os.path.normpath(outdir) + '_manifest.json'
+
+    def save(self):
+        """Save the manifest to file."""
+        import json
+        temppath = self.path + '.tmp'
+        with open(temppath, 'w') as file:
+            json.dump(self.entries, file, separators=(',', ':'),
+                      sort_keys=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temppath, self.path)
+
+    def prune(self, outdir, archives, paths):
+        """Delete extracted files which are no longer in any archive.
+
+        Params:
+        * `outdir`: Output folder.
+        * `archives`: Archive paths unpacked in this run.
+        * `paths`: Internal file paths unpacked in this run.
+
+        A file is deleted if it was not unpacked in this run, and its source \
+        archive either was unpacked in this run or no longer exists.
+
+        Return the number of deleted files.
+        """
+        removed_count = 0
+        for path, entry in list(self.entries.items()):
+            if path in paths:
+                continue
+            if entry[0] in archives or not os.path.isfile(entry[0]):
+                outpath = _outpath(outdir, path)
+                if os.path.isfile(outpath):
+                    os.remove(outpath)
+                del self.entries[path]
+                removed_count += 1
+        return removed_count
+
+
+def _plan(filepath, outdir, manifest=None, force=False):
+    """Create output directories of an archive and split it into tasks.
+
+    Each task is a tuple of (archive path, output folder, file indices, \
+    byte count, previous manifest entries), and holds roughly `CHUNK_SIZE` \
+    bytes of file data. Previous manifest entries are None without a \
+    manifest, and are all None with `force`, so that all files are written.
+    """
+    filepath = os.path.abspath(filepath)
+    tasks = []
+    with Arc(filepath, use_mmap=True) as bin:
+        outsubdirs = set(os.path.dirname(_outpath(outdir, entry.path))
+                         for entry in bin.file_entries)
+        for outsubdir in outsubdirs:
+            if not os.path.isdir(outsubdir):
+                os.makedirs(outsubdir)
+
+        indices = []
+        chunk_length = 0
+        for file_index, entry in enumerate(bin.file_entries):
+            indices.append(file_index)
+            chunk_length += entry.file_length
+            if chunk_length >= CHUNK_SIZE:
+                tasks.append((filepath, outdir, indices, chunk_length))
+                indices = []
+                chunk_length = 0
+        if indices or not tasks:
+            tasks.append((filepath, outdir, indices, chunk_length))
+
+        if manifest is None:
+            return [task + (None,) for task in tasks]
+        return [task + ({bin.getfilepath(i): None if force else
+                         manifest.entries.get(bin.getfilepath(i))
+                         for i in task[2]},)
+                for task in tasks]
+
+
+def _unpack_task(task):
+    """Write files of a task.
+
+    Files whose previous manifest entry matches are skipped.
+
+    Return a tuple of (archive path, written file count, written byte count, \
+    manifest entries). Manifest entries are None without a manifest.
+    """
+    filepath, outdir, indices, _, previous = task
+    file_count = 0
+    byte_count = 0
+    entries = None if previous is None else {}
+    with Arc(filepath, use_mmap=True) as bin:
+        for file_index in indices:
+            path = bin.getfilepath(file_index)
+            outpath = _outpath(outdir, path)
+            data = bin.getdata(file_index)
+            try:
+                if previous is not None:
+                    entry = bin.file_entries[file_index]
+                    entries[path] = [filepath, entry.file_offset,
+                                     entry.file_length,
+                                     zlib.crc32(data) & 0xFFFFFFFF]
+                    if entries[path] == previous[path] and \
+                            os.path.isfile(outpath) and \
+                            os.path.getsize(outpath) == entry.file_length:
+                        continue
+                with instrument.stage('arc.write') as stage, \
+                        io.open(outpath, 'wb', buffering=BUFFER_SIZE) as file:
+                    file.write(data)
+                    stage.add(bytes=len(data))
+                file_count += 1
+                byte_count += len(data)
+            finally:
+                _release(data)
+    return filepath, file_count, byte_count, entries
+
+
+def _pooled_unpack_task(task):
+    """Run `_unpack_task` in a worker process, and add its statistics."""
+    return _unpack_task(task) + (instrument.collect(),)
+
+
+def _run(tasks, outdir, jobs=1, progress=None, manifest=None):
+    """Run unpacking tasks. Return (file count, byte count, removed count)."""
+    # Biggest tasks first, so that one large archive does not finish last.
+    tasks.sort(key=lambda task: -task[3])
+    file_count = 0
+    byte_count = 0
+    paths = set()
+    pool = None
+    if jobs > 1:
+        import multiprocessing
+        # Workers forked while instrumented start without parent statistics.
+        pool = multiprocessing.Pool(jobs, instrument.reset)
+        results = pool.imap_unordered(_pooled_unpack_task, tasks)
+    else:
+        results = (_unpack_task(task) + (None,) for task in tasks)
+    try:
+        for done, (_, task_file_count, task_byte_count, entries, stats) in \
+                enumerate(results, 1):
+            instrument.merge(stats)
+            file_count += task_file_count
+            byte_count += task_byte_count
+            if entries is not None:
+                manifest.entries.update(entries)
+                paths.update(entries)
+            if progress is not None:
+                progress(done, len(tasks), file_count, byte_count)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    removed_count = 0
+    if manifest is not None:
+        archives = set(task[0] for task in tasks)
+        removed_count = manifest.prune(outdir, archives, paths)
+        manifest.save()
+    return file_count, byte_count, removed_count
+
+
+def unpack_file(filepath, outdir, manifest=None, force=False):
+    """Unpack file in `filepath` to `outdir`.
+
+    If a `Manifest` object is given, unchanged files are skipped and files \
+    which were removed from the archive are deleted. With `force`, \
+    unchanged files are written too.
+
+    Return a tuple of (written file count, written byte count).
+    """
+    file_count, byte_count, _ = _run(_plan(filepath, outdir, manifest, force),
+                                     outdir, manifest=manifest)
+    return file_count, byte_count
+
+
+def unpack_folder(path, outdir, jobs=1, progress=None, manifest=None,
+                  catalog=None, force=False):
+    """Unpack all archives in `path` to `outdir`.
+
+    Params:
+    * `path`: Input folder. Files which are not archives are skipped.
+    * `outdir`: Output folder.
+    * `jobs`: Number of worker processes. Large archives are split across \
+      workers too.
+    * `progress`: Optional callable, called with (done tasks, total tasks, \
+      written file count, written byte count) after each task.
+    * `manifest`: Optional `Manifest` object. If given, unchanged files are \
+      skipped, and files which are no longer in any archive are deleted.
+    * `catalog`: Optional `Catalog` object of `path`. If given, only files \
+      cataloged as archives are opened.
+    * `force`: If True, write unchanged files too. Files which are no \
+      longer in any archive are still deleted.
+
+    Return a tuple of (archive count, written file count, written byte \
+    count, deleted file count).
+    """
+    if catalog is not None:
+        filepaths = catalog.paths(ARC)
+    else:
+        filepaths = [os.path.join(dirpath, filename)
+                     for dirpath, dirnames, filenames in os.walk(path)
+                     for filename in filenames]
+    tasks = []
+    archives = set()
+    for filepath in filepaths:
+        try:
+            tasks.extend(_plan(filepath, outdir, manifest, force))
+        except (InvalidFileError, TypeError, struct_error):
+            continue
+        archives.add(filepath)
+
+    file_count, byte_count, removed_count = \
+        _run(tasks, outdir, jobs, progress, manifest)
+    return len(archives), file_count, byte_count, removed_count
+
+
+def _printprogress(done, total, file_count, byte_count):
+    sys.stderr.write('\r[{}/{}] {} files, {:.1f} MB'.format(
+        done, total, file_count, byte_count / 0x100000))
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+
+
+def find_main(argv):
+    """Entry point of the `find` command."""
+    parser = argparse.ArgumentParser(prog='arc.py find')
+    parser.add_argument('path', help='internal file path')
+    parser.add_argument('-d', '--dump', default='archive\\bin',
+                        help='folder which contains all archives')
+    parser.add_argument('-i', '--index', default=None,
+                        help='index path (default: <dump>_index.sqlite)')
+    parser.add_argument('-o', '--out', default=None,
+                        help='write file data to this path')
+    parser.add_argument('--no-update', action='store_true',
+                        help='do not refresh the index before searching')
+    instrument.add_argument(parser)
+    args = parser.parse_args(argv)
+    instrument.setup(args)
+
+    indexpath = args.index or os.path.normpath(args.dump) + '_index.sqlite'
+    with ArcIndex(indexpath) as index:
+        if not args.no_update:
+            index.update(args.dump)
+        location = index.find(args.path)
+        if location is None:
+            print('{} not found.'.format(args.path))
+            return 1
+        print('{}\t0x{:08X}\t0x{:X}'.format(*location))
+        if args.out:
+            with open(args.out, 'wb') as file:
+                file.write(Arc.open_by_path(index, args.path))
+    return 0
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'find':
+        status = find_main(sys.argv[2:])
+        instrument.report()
+        sys.exit(status)
+
     parser = argparse.ArgumentParser()
     parser.add_argument('path', nargs='?', default='archive\\bin',
                         help='path to bin file.')
     parser.add_argument('-o', '--out', default='bin', help='output folder')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes for folders')
+    parser.add_argument('-f', '--force', action='store_true',
+                        help='rewrite all files, even unchanged ones')
+    instrument.add_argument(parser)
     args = parser.parse_args()
+    instrument.setup(args)
+
+    manifest = Manifest(Manifest.default_path(args.out))
 
     if os.path.isfile(args.path):
-        unpack_file(args.path, args.out)
+        file_count, byte_count = unpack_file(args.path, args.out, manifest,
+                                             args.force)
+        print('{} files written, {:.1f} MB'.format(
+            file_count, byte_count / 0x100000))
 
     elif os.path.isdir(args.path):
-        for dirpaths, dirnames, filenames in os.walk(args.path):
-            for filename in filenames:
-                path = os.path.join(dirpaths, filename)
-                try:
-                    unpack_file(path, args.out)
-                    print(path)
-                except (TypeError, struct_error):
-                    pass
+        archive_count, file_count, byte_count, removed_count = unpack_folder(
+            args.path, args.out, args.jobs, _printprogress, manifest,
+            open_catalog(args.path), args.force)
+        print('{} archives, {} files written, {:.1f} MB, {} files deleted'
+              .format(archive_count, file_count, byte_count / 0x100000,
+                      removed_count))
 
     else:
-        print('{} is not an existing file or folder.'.format(args.path))
\ No newline at end of file
+        print('{} is not an existing file or folder.'.format(args.path))
+    instrument.report()
@@ -0,0 +1,339 @@
+#!/usr/bin/env python
+"""Benchmarks of Fantasy Life tools, over synthetic archives and SCR files.
+
+Results can be saved as JSON, and compared with a previous run.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from collections import OrderedDict
+from struct import pack
+from timeit import default_timer
+
+from .arc import Arc, _release
+from .scr import SCR, TableManager
+from .table import SAMPLE_TABLEINFO, feed, newrowclass
+
+
+###############################################################################
+# Synthetic files
+###############################################################################
+def _chr(code):
+    return chr(code) if sys.version_info[0] >= 3 else unichr(code)
+
+
+def _text(rng, min_length=0, max_length=12):
+    chars = []
+    for _ in range(rng.randint(min_length, max_length)):
+        chars.append(rng.choice([
+            rng.randint(0x20, 0x7E), rng.randint(0x3041, 0x3096),
+            rng.randint(0x4E00, 0x9FA0), 0xFFF2, 0xFF01]))
+    return ''.join(_chr(c) for c in chars).encode('utf-16le')
+
+
+def _branch(rng):
+    text1 = _text(rng)
+    text2 = _text(rng)
+    return (b'\xE9\xFF\xFF\xFF' + b'\0' * 18 + pack('<H', len(text1) + 2)
+            + text1 + b'\0\0' + rng.choice([b'', b'\xFF\xFF'])
+            + b'\0\0' + pack('<H', len(text2) + 2) + text2 + b'\0\0')
+
+
+def _furigana(rng):
+    furigana = _text(rng)
+    return (b'\xF4\xFF\xFF\xFF' + b'\0' * 6 + pack('<H', len(furigana))
+            + furigana)
+
+
+def _choice(rng):
+    choices = [_text(rng, 1) + b'\0\0' * rng.randint(0, 2)
+               for _ in range(rng.randint(1, 4))]
+    return (b'\xF5\xFF\xFF\xFF' + b'\0' * 8 + pack('<I', len(choices))
+            + b'\0' * 4 * len(choices) + b''.join(
+                b'\0' * 4 + pack('<H', len(c)) + b'\0\0' + c
+                for c in choices))
+
+
+# Builders of string pieces: plain text, or one control code of each kind
+# handled by SCR.getstring.
+PIECES = OrderedDict([
+    ('text', _text),
+    ('long_text', lambda rng: _text(rng, 20, 80)),
+    ('skip', lambda rng: b'\xFF\xFF'),
+    ('branch', _branch),
+    ('line_break', lambda rng: b'\xF0\xFF\xFF\xFF' + b'\0' * 4),
+    ('pause', lambda rng: b'\xF1\xFF\xFF\xFF' + b'\0' * 4),
+    ('furigana', _furigana),
+    ('choice', _choice),
+    ('variables', lambda rng: b'\xF6\xFF\xFF\xFF' + pack(
+        '<II', rng.randint(0, 99), rng.randint(0, 99))),
+    ('text_color', lambda rng: b'\xF7\xFF\xFF\xFF' + pack(
+        '<II', 0, rng.choice([0, 3, 4]))),
+    ('button', lambda rng: b'\xF9\xFF\xFF\xFF' + pack(
+        '<II', 0, rng.randint(0, 12))),
+])
+
+# Relative weights of string pieces.
+STRING_MIXES = {
+    'plain': {'long_text': 1},
+    'dialogue': {'long_text': 6, 'text': 4, 'line_break': 3, 'pause': 2,
+                 'button': 1, 'variables': 1, 'text_color': 2, 'furigana': 1},
+    'all': dict((name, 1) for name in PIECES if name != 'long_text'),
+}
+
+
+def make_string(rng, mix='all', max_pieces=8):
+    """Return raw bytes of a random string, with its terminator.
+
+    Params:
+    * `rng`: A `random.Random` object.
+    * `mix`: Name of a mix in `STRING_MIXES`, or a dict of piece weights.
+    * `max_pieces`: Maximum number of pieces in the string.
+    """
+    if not isinstance(mix, dict):
+        mix = STRING_MIXES[mix]
+    names = sorted(mix)
+    weights = [mix[name] for name in names]
+    total = sum(weights)
+    pieces = []
+    for _ in range(rng.randint(1, max_pieces)):
+        value = rng.uniform(0, total)
+        for name, weight in zip(names, weights):
+            value -= weight
+            if value <= 0:
+                break
+        pieces.append(PIECES[name](rng))
+    return b''.join(pieces) + b'\0\0'
+
+
+def make_scr(row_count=10000, string_count=2000, mix='all', seed=0):
+    """Return data of a synthetic SCR file.
+
+    Rows follow `SAMPLE_TABLEINFO`. Their string column points to one of \
+    `string_count` random strings, so that offsets are shared by rows.
+    """
+    rng = random.Random(seed)
+    Row = newrowclass(SAMPLE_TABLEINFO)
+    strings = [make_string(rng, mix) for _ in range(string_count)]
+    table_offset = 0x30
+    pool_offset = table_offset + row_count * Row.struct_obj.size
+    offsets = []
+    pool = bytearray()
+    for string in strings:
+        offsets.append(pool_offset + len(pool))
+        pool += string
+
+    raw = bytearray(pack('<4s16xI', SCR.MAGIC, 0x18))
+    raw += pack('<3I', row_count, Row.struct_obj.size, table_offset)
+    raw += b'\0' * (table_offset - len(raw))
+    for i in range(row_count):
+        a, b, c = rng.randint(0, 7), rng.randint(0, 31), rng.randint(0, 15)
+        row = Row(id=i & 0xFFFF, c2=b'\0\0', name=rng.randrange(string_count),
+                  flags=a | b << 3 | c << 12, a=a, b=b, c=c,
+                  kind=rng.choice(['Weapon', 'Armor', 'Tool']), c11=b'\0',
+                  price=rng.randint(-100, 100000), stat=rng.random(),
+                  c20=b'\0' * 4)
+        raw += Row.struct_obj.pack(*row.toraw(offsets.__getitem__))
+    raw += pool
+    return bytes(raw)
+
+
+def make_arc(path, file_count=1000, file_size=0x1000, seed=0):
+    """Write a synthetic archive with `file_count` files to `path`.
+
+    File sizes are random, up to twice `file_size`.
+    """
+    rng = random.Random(seed)
+    data = bytearray(0x14)
+    entries = []
+    for i in range(file_count):
+        length = rng.randint(0, 2 * file_size)
+        entries.append(['data/{:03d}/{:08d}.bin'.format(i // 100, i),
+                        len(data), length])
+        data += os.urandom(length)
+        data += b'\0' * (-len(data) & 3)
+    for entry in entries:
+        entry.append(len(data))
+        data += entry[0].encode('ascii') + b'\0'
+    data += b'\0' * (-len(data) & 3)
+    entries_offset = len(data)
+    for path_, file_offset, file_length, path_offset in entries:
+        data += Arc.ENTRY_STRUCT.pack(0, len(path_), 0, 0, file_length,
+                                      path_offset, file_offset)
+    data[:0x14] = pack('<4s4I', Arc.MAGIC, len(data) - 0x14, 0, 0,
+                       entries_offset)
+    with open(path, 'wb') as file:
+        file.write(data)
+
+
+###############################################################################
+# Benchmarks
+###############################################################################
+def _time(function, repeat):
+    """Return the best time of `repeat` calls of `function`."""
+    best = None
+    for _ in range(repeat):
+        start = default_timer()
+        function()
+        elapsed = default_timer() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+
+def run(rows=20000, strings=4000, files=2000, file_size=0x1000, repeat=3,
+        mix='dialogue', progress=None):
+    """Run all benchmarks. Return an OrderedDict of results.
+
+    Each result is a dict with the best time in `seconds`, and the number \
+    of items processed per second in `rate`, counted in `unit`.
+    """
+    results = OrderedDict()
+
+    def record(name, function, count, unit):
+        seconds = _time(function, repeat)
+        results[name] = OrderedDict([
+            ('seconds', seconds), ('rate', count / seconds), ('unit', unit)])
+        if progress is not None:
+            progress(name, results[name])
+
+    tempdir = tempfile.mkdtemp()
+    tables = TableManager.tables
+    try:
+        # Arc
+        arcpath = os.path.join(tempdir, 'bench.bin')
+        make_arc(arcpath, files, file_size)
+        record('arc.open', lambda: Arc(arcpath).close(), files, 'entries/s')
+        record('arc.open_mmap', lambda: Arc(arcpath, True).close(), files,
+               'entries/s')
+
+        def getdata(use_mmap):
+            with Arc(arcpath, use_mmap) as bin:
+                for file_index in range(bin.file_count):
+                    _release(bin.getdata(file_index))
+
+        byte_count = os.path.getsize(arcpath)
+        record('arc.getdata', lambda: getdata(False), byte_count, 'bytes/s')
+        record('arc.getdata_mmap', lambda: getdata(True), byte_count,
+               'bytes/s')
+
+        # SCR
+        raw = make_scr(rows, strings, mix)
+        scrpath = os.path.join(tempdir, 'bench.scr')
+        with open(scrpath, 'wb') as file:
+            file.write(raw)
+        Row = newrowclass(SAMPLE_TABLEINFO)
+        scr = SCR(raw, cache_size=0)
+        offsets = sorted(set(Row.feed(bytes_obj).name
+                             for bytes_obj in scr.iterrowbytes()))
+
+        def getstring(scr):
+            for offset in offsets:
+                scr.getstring(offset)
+
+        record('scr.getstring', lambda: getstring(scr), len(offsets),
+               'strings/s')
+        record('scr.predecode', lambda: SCR(raw, predecode=True),
+               strings, 'strings/s')
+
+        rowbytes = list(scr.iterrowbytes())
+        record('row.feed', lambda: [Row.feed(bytes_obj) for bytes_obj
+                                    in rowbytes], rows, 'rows/s')
+        record('row.feed_generic', lambda: [feed(Row, bytes_obj) for bytes_obj
+                                            in rowbytes], rows, 'rows/s')
+
+        # The benchmark table is added to a copy, so that tables.json is
+        # still loaded by the next `TableManager` when none was loaded yet.
+        info = OrderedDict(SAMPLE_TABLEINFO)
+        info['paths'] = OrderedDict([('en', scrpath)])
+        TableManager.tables = OrderedDict(tables or ())
+        TableManager.tables['_bench'] = info
+        manager = TableManager()
+
+        def loadtable(backend):
+            table = manager.loadtable('_bench', 'en', backend=backend)
+            for _ in table.itercolumn(2):
+                pass
+
+        for backend in ('rows', 'lazy', 'columnar'):
+            record('loadtable.' + backend, lambda: loadtable(backend), rows,
+                   'rows/s')
+
+        record('scr.tolines', lambda: SCR(raw).tolines(string_offsets=[4]),
+               rows, 'rows/s')
+    finally:
+        TableManager.tables = tables
+        shutil.rmtree(tempdir)
+    return results
+
+
+def _git_revision():
+    import subprocess
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.STDOUT).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('-o', '--out', help='write results to this JSON file')
+    parser.add_argument('-c', '--compare', help='compare with a JSON file')
+    parser.add_argument('--rows', type=int, default=20000,
+                        help='rows in the synthetic SCR file')
+    parser.add_argument('--strings', type=int, default=4000,
+                        help='strings in the synthetic SCR file')
+    parser.add_argument('--mix', default='dialogue',
+                        choices=sorted(STRING_MIXES), help='string mix')
+    parser.add_argument('--files', type=int, default=2000,
+                        help='files in the synthetic archive')
+    parser.add_argument('--file-size', type=int, default=0x1000,
+                        help='average file size in the synthetic archive')
+    parser.add_argument('-r', '--repeat', type=int, default=3,
+                        help='runs of each benchmark, the best one is kept')
+    args = parser.parse_args(argv)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, 'r') as file:
+            baseline = json.load(file)['results']
+
+    def progress(name, result):
+        line = '{:24}{:14.0f} {}'.format(name, result['rate'], result['unit'])
+        if baseline is not None and name in baseline:
+            line += '  {:+.1%}'.format(
+                result['rate'] / baseline[name]['rate'] - 1)
+        print(line)
+
+    results = run(args.rows, args.strings, args.files, args.file_size,
+                  args.repeat, args.mix, progress)
+    if args.out:
+        report = OrderedDict([
+            ('revision', _git_revision()),
+            ('time', time.strftime('%Y-%m-%dT%H:%M:%S')),
+            ('python', platform.python_version()),
+            ('platform', platform.platform()),
+            ('params', OrderedDict([
+                ('rows', args.rows), ('strings', args.strings),
+                ('mix', args.mix), ('files', args.files),
+                ('file_size', args.file_size), ('repeat', args.repeat)])),
+            ('results', results),
+        ])
+        with open(args.out, 'w') as file:
+            json.dump(report, file, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
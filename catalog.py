@@ -0,0 +1,204 @@
+#!/usr/bin/env python
+"""Catalog of the file types in a folder, such as a dump of the game files.
+
+Files are classified from their first 0x20 bytes only, so tools can skip \
+files they cannot parse without opening them.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import io
+import os
+from struct import unpack_from
+try:
+    from os import scandir
+except ImportError: # Before Python 3.5
+    scandir = None
+
+
+ARC = 'arc'
+SCR = 'scr'
+UNKNOWN = 'unknown'
+
+HEADER_SIZE = 0x20  # Bytes read from each file
+ARC_MAGIC = b'R \rC'  # Same as `Arc.MAGIC`
+SCR_MAGIC = b'\x13\x80\x03\x1D'  # Same as `SCR.MAGIC`
+JOBS = 8  # Default number of threads reading headers
+
+
+def classify(header, size):
+    """Classify a file from its first bytes and its size.
+
+    Return a tuple of (kind, data offset). Kind is `ARC`, `SCR` or \
+    `UNKNOWN`. The data offset is 0x10 for SCR files with a header, and 0 \
+    otherwise.
+    """
+    if header[:4] == ARC_MAGIC and size >= 0x14 and len(header) >= 8 and \
+            0x14 + unpack_from('<I', header, 4)[0] == size:
+        return ARC, 0
+    for offset in (0, 0x10):
+        if header[offset:offset + 4] == SCR_MAGIC:
+            return SCR, offset
+    return UNKNOWN, 0
+
+
+def sniff(path, size=None):
+    """Classify the file at `path`. See `classify`."""
+    with io.open(path, 'rb') as file:
+        header = file.read(HEADER_SIZE)
+        if size is None:
+            file.seek(0, os.SEEK_END)
+            size = file.tell()
+    return classify(header, size)
+
+
+def _iterfiles(folder):
+    """Yield (path, size, modification time) of all files in `folder`."""
+    if scandir is None:
+        for dirpath, dirnames, filenames in os.walk(folder):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                stat = os.stat(path)
+                yield path, stat.st_size, stat.st_mtime
+        return
+
+    folders = [folder]
+    while folders:
+        for entry in scandir(folders.pop()):
+            if entry.is_dir():
+                folders.append(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                yield entry.path, stat.st_size, stat.st_mtime
+
+
+def _sniffentry(item):
+    relpath, path, size, mtime = item
+    try:
+        kind, offset = sniff(path, size)
+    except (IOError, OSError):
+        kind, offset = UNKNOWN, 0
+    return relpath, [kind, offset, size, mtime]
+
+
+class Catalog(object):
+    """Kinds of all files in a folder.
+
+    Each entry maps a path relative to the folder, with '/' separators, to \
+    a list of [kind, data offset, size, modification time]. The catalog is \
+    saved as JSON, and files whose size and modification time did not \
+    change are not read again.
+    """
+
+    def __init__(self, folder, path=None):
+        """Params:
+        * `folder`: Cataloged folder.
+        * `path`: Path of the catalog file. See `default_path`.
+        """
+        self.folder = folder
+        self.path = path or Catalog.default_path(folder)
+        self.entries = {}
+        if os.path.isfile(self.path):
+            import json
+            with io.open(self.path, 'r', encoding='utf-8') as file:
+                self.entries = json.load(file)
+
+    @staticmethod
+    def default_path(folder):
+        """Return the default catalog path of `folder`."""
+        return os.path.normpath(folder) + '_catalog.json'
+
+    def update(self, jobs=JOBS):
+        """Catalog new and changed files, with `jobs` threads.
+
+        Entries of files which no longer exist are removed.
+
+        Return the number of files read.
+        """
+        ownpath = os.path.abspath(self.path)
+        entries = {}
+        stale = []
+        for path, size, mtime in _iterfiles(self.folder):
+            if os.path.abspath(path) == ownpath:
+                continue
+            relpath = os.path.relpath(path, self.folder).replace(os.sep, '/')
+            entry = self.entries.get(relpath)
+            if entry is not None and entry[2] == size and entry[3] == mtime:
+                entries[relpath] = entry
+            else:
+                stale.append((relpath, path, size, mtime))
+
+        if jobs > 1 and len(stale) > 1:
+            from multiprocessing.pool import ThreadPool
+            pool = ThreadPool(jobs)
+            try:
+                entries.update(pool.imap_unordered(_sniffentry, stale, 16))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            entries.update(_sniffentry(item) for item in stale)
+        self.entries = entries
+        return len(stale)
+
+    def save(self):
+        """Save the catalog to file."""
+        import json
+        temppath = self.path + '.tmp'
+        with open(temppath, 'w') as file:
+            json.dump(self.entries, file, separators=(',', ':'),
+                      sort_keys=True)
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        os.rename(temppath, self.path)
+
+    def paths(self, kind=None):
+        """Return sorted paths of the files of `kind`, or of all files."""
+        return [os.path.join(self.folder, relpath.replace('/', os.sep))
+                for relpath, entry in sorted(self.entries.items())
+                if kind is None or entry[0] == kind]
+
+    def counts(self):
+        """Return a dict of the number of files of each kind."""
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry[0]] = counts.get(entry[0], 0) + 1
+        return counts
+
+
+def open_catalog(folder, jobs=JOBS):
+    """Return the updated catalog of `folder`.
+
+    The catalog is saved if possible: a catalog which cannot be written, \
+    e.g. next to a read-only folder, is only used for this run.
+    """
+    catalog = Catalog(folder)
+    if catalog.update(jobs) or not os.path.isfile(catalog.path):
+        try:
+            catalog.save()
+        except (IOError, OSError):
+            pass
+    return catalog
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='archive\\bin',
+                        help='folder to catalog')
+    parser.add_argument('-j', '--jobs', type=int, default=JOBS,
+                        help='number of threads reading files')
+    parser.add_argument('-l', '--list', choices=(ARC, SCR, UNKNOWN),
+                        help='print paths of files of this kind')
+    args = parser.parse_args()
+
+    catalog = Catalog(args.path)
+    read_count = catalog.update(args.jobs)
+    catalog.save()
+    if args.list:
+        for path in catalog.paths(args.list):
+            print(path)
+    else:
+        counts = catalog.counts()
+        print('{} files read, {} arc, {} scr, {} unknown'.format(
+            read_count, counts.get(ARC, 0), counts.get(SCR, 0),
+            counts.get(UNKNOWN, 0)))
@@ -0,0 +1,438 @@
+#!/usr/bin/env python
+"""Local query server which keeps Fantasy Life tables loaded.
+
+Requires Python 3. Clients send one JSON request per line to a Unix socket \
+(or to a localhost TCP port), and receive one JSON response per line:
+
+    {"op": "row", "table": "items", "language": "en", "index": 47}
+    {"ok": true, "result": {"index": 47, "row": {...}}}
+
+Operations:
+* `tables`: Names of all tables, with their languages.
+* `row`: Row at `index`.
+* `rows`: Rows from `start` to `stop` (at most `limit`, 100 by default).
+* `column`: Values of `column`, from `start` to `stop`.
+* `lookup`: Rows whose `column` equals `value`.
+* `where`: Rows with `lo` <= `column` <= `hi`, sorted by `column`.
+* `find`: Archive, file offset and file length of the internal file `path`, \
+  in the archives of `dump`.
+* `stats`: Cache statistics.
+
+Table operations take `table`, and either `language` or `args`, the list of \
+table parameters of `TableManager.loadtable`. Rows are objects keyed by \
+column name, with gap bytes as hexadecimal strings.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import asyncio
+import json
+import os
+import signal
+import socket
+import sys
+import tempfile
+import time
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+
+from . import instrument
+from .arc import ArcIndex
+from .scr import TableManager, _loadschemas
+from .table import _rowclasses
+
+
+MEMORY_BUDGET = 0x10000000  # Default bytes of tables kept loaded
+ROW_LIMIT = 100  # Default maximum rows of a response
+RESCAN_INTERVAL = 60  # Minimum seconds between archive rescans after misses
+
+
+def default_socket_path():
+    """Return the default socket path of the current user."""
+    uid = os.getuid() if hasattr(os, 'getuid') else 0
+    return os.path.join(tempfile.gettempdir(), 'fltools-{}.sock'.format(uid))
+
+
+def _tablesize(table):
+    """Estimate the memory used by a table, from up to 100 of its rows."""
+    size = sys.getsizeof(table)
+    if not table:
+        return size
+    sample = table[::max(len(table) // 100, 1)]
+    rowsize = sum(sys.getsizeof(row) + sum(sys.getsizeof(value)
+                                           for value in row)
+                  for row in sample) / len(sample)
+    return int(size + rowsize * len(table))
+
+
+def _jsonvalue(value):
+    if isinstance(value, bytes):
+        return value.hex()
+    return value
+
+
+def _jsonrow(row):
+    return OrderedDict((name, _jsonvalue(value))
+                       for name, value in zip(row._fields, row))
+
+
+class RequestError(Exception):
+    """Invalid request, reported to the client."""
+
+
+class TableCache(object):
+    """Tables loaded by `TableManager`, evicted in least recently used order.
+
+    Tables are loaded again when their file or tables.json changes.
+    """
+
+    def __init__(self, budget=MEMORY_BUDGET, loop=None):
+        """Params:
+        * `budget`: Estimated bytes of tables kept loaded. The most recently \
+          used table is kept, even if it is larger.
+        * `loop`: Event loop. Tables are loaded in its default executor.
+        """
+        self.budget = budget
+        self.loop = loop
+        self.manager = TableManager()
+        self.schemapath = os.path.join(os.path.dirname(__file__),
+                                       'tables.json')
+        self.schemastat = self._stat(self.schemapath)
+        self.generation = 0  # Number of tables.json reloads
+        self.entries = OrderedDict()  # Key: (table, file stat, size)
+        self.loading = {}  # (generation, key): future of a table being loaded
+        self.size = 0
+        self.stats = OrderedDict([('hits', 0), ('loads', 0), ('reloads', 0),
+                                  ('evictions', 0)])
+
+    @staticmethod
+    def _stat(path):
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_mtime, stat.st_size
+
+    def _checkschemas(self):
+        """Reload tables.json and drop all tables if it changed."""
+        stat = self._stat(self.schemapath)
+        if stat == self.schemastat:
+            return
+        TableManager.tables, TableManager.compiled = \
+            _loadschemas(self.schemapath)
+        _rowclasses.clear()
+        self.entries.clear()
+        self.size = 0
+        self.schemastat = stat
+        self.generation += 1
+        self.stats['reloads'] += 1
+
+    def path(self, name, args):
+        """Return the file path of a table."""
+        try:
+            path = TableManager.tables[name]['paths']
+            for arg in args:
+                path = path[arg]
+        except (KeyError, TypeError):
+            raise RequestError('unknown table {!r} {!r}'.format(name, args))
+        if not isinstance(path, str):
+            raise RequestError('missing table parameters of {!r}'.format(name))
+        return path
+
+    async def get(self, name, args):
+        """Return the `Table` object of table `name` with parameters `args`.
+
+        Tables loaded while tables.json changed are loaded again.
+        """
+        while True:
+            self._checkschemas()
+            generation = self.generation
+            key = (name,) + tuple(args)
+            stat = self._stat(self.path(name, args))
+            if stat is None:
+                raise RequestError('missing file of table {!r} {!r}'.format(
+                    name, args))
+
+            entry = self.entries.get(key)
+            if entry is not None:
+                if entry[1] == stat:
+                    self.entries.move_to_end(key)
+                    self.stats['hits'] += 1
+                    return entry[0]
+                self._evict(key)
+                self.stats['reloads'] += 1
+
+            # Requests of a table being loaded wait for the same load.
+            loadkey = (generation, key)
+            future = self.loading.get(loadkey)
+            if future is not None:
+                table = (await future)[0]
+            else:
+                future = self.loop.run_in_executor(
+                    None, self._load, name, tuple(args))
+                self.loading[loadkey] = future
+                try:
+                    table, size = await future
+                finally:
+                    del self.loading[loadkey]
+                if generation == self.generation:
+                    self.stats['loads'] += 1
+                    self.entries[key] = (table, stat, size)
+                    self.size += size
+                    while self.size > self.budget and len(self.entries) > 1:
+                        self._evict(next(iter(self.entries)))
+                        self.stats['evictions'] += 1
+                else:
+                    # The row class of the old schema may have been cached
+                    # after the reload.
+                    _rowclasses.pop(name, None)
+            if generation == self.generation:
+                return table
+
+    def _load(self, name, args):
+        table = self.manager.loadtable(name, *args)
+        return table, _tablesize(table)
+
+    def _evict(self, key):
+        table, stat, size = self.entries.pop(key)
+        self.size -= size
+
+
+class Server(object):
+    """JSON line server of table and archive queries."""
+
+    def __init__(self, budget=MEMORY_BUDGET, dump=None):
+        """Params:
+        * `budget`: Memory budget of the table cache, in bytes.
+        * `dump`: Default folder of archives of `find` requests.
+        """
+        self.budget = budget
+        self.dump = dump
+        self.cache = None
+        self.indexes = {}  # Dump folder: time of the last index update
+        self.updating = {}  # Dump folder: future of an index update
+
+    async def serve(self, socket_path=None, port=None):
+        """Serve forever, on `port` of localhost, or on a Unix socket."""
+        self.cache = TableCache(self.budget, asyncio.get_running_loop())
+        if port is not None:
+            server = await asyncio.start_server(self.handle, '127.0.0.1',
+                                                port)
+        else:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            server = await asyncio.start_unix_server(self.handle,
+                                                     socket_path)
+        async with server:
+            await server.serve_forever()
+
+    async def handle(self, reader, writer):
+        """Answer the requests of a client, one per line."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                writer.write(json.dumps(await self.respond(line)).encode(
+                    'utf-8') + b'\n')
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, line):
+        """Return the response object to a request line."""
+        try:
+            request = json.loads(line.decode('utf-8'))
+            if not isinstance(request, dict):
+                raise RequestError('request must be an object')
+            op = request.get('op')
+            method = getattr(self, 'op_' + str(op), None)
+            if method is None:
+                raise RequestError('unknown op {!r}'.format(op))
+            with instrument.stage('daemon.' + op):
+                result = await method(request)
+            return {'ok': True, 'result': result}
+        except Exception as e: # Reported to the client, which may go on.
+            return {'ok': False, 'error': '{}: {}'.format(
+                type(e).__name__, e)}
+
+    async def _table(self, request):
+        if 'args' in request:
+            args = request['args']
+        elif 'language' in request:
+            args = [request['language']]
+        else:
+            args = []
+        return await self.cache.get(request['table'], args)
+
+    @staticmethod
+    def _rows(table, row_indices):
+        return [OrderedDict([('index', i), ('row', _jsonrow(table[i]))])
+                for i in row_indices]
+
+    async def op_tables(self, request):
+        self.cache._checkschemas()
+        return OrderedDict((name, list(info['paths']))
+                           for name, info in TableManager.tables.items())
+
+    async def op_row(self, request):
+        table = await self._table(request)
+        return self._rows(table, [int(request['index'])])[0]
+
+    async def op_rows(self, request):
+        table = await self._table(request)
+        start = int(request.get('start', 0))
+        stop = min(int(request.get('stop', len(table))),
+                   start + int(request.get('limit', ROW_LIMIT)))
+        return self._rows(table, range(start, min(stop, len(table))))
+
+    async def op_column(self, request):
+        table = await self._table(request)
+        if not table:
+            return []
+        column = table._columnindex(request['column'])
+        start = int(request.get('start', 0))
+        stop = int(request.get('stop', len(table)))
+        return [_jsonvalue(row[column]) for row in table[start:stop]]
+
+    async def op_lookup(self, request):
+        table = await self._table(request)
+        if not table:
+            return []
+        row_indices = table.hashindex(request['column']).get(
+            request['value'], ())
+        return self._rows(table, row_indices[:int(request.get(
+            'limit', ROW_LIMIT))])
+
+    async def op_where(self, request):
+        table = await self._table(request)
+        if not table:
+            return []
+        values, row_indices = table.sortedindex(request['column'])
+        lo, hi = request.get('lo'), request.get('hi')
+        start = 0 if lo is None else bisect_left(values, lo)
+        stop = len(values) if hi is None else bisect_right(values, hi)
+        stop = min(stop, start + int(request.get('limit', ROW_LIMIT)))
+        return self._rows(table, row_indices[start:stop])
+
+    @staticmethod
+    def _findpath(dump, path, update):
+        """Find `path` in the archive index of `dump`, after updating the \
+        index if `update` is True. Run in an executor thread, with its own \
+        connection.
+        """
+        with ArcIndex(os.path.normpath(dump) + '_index.sqlite') as index:
+            if update:
+                index.update(dump)
+            return index.find(path)
+
+    async def _find(self, dump, path, update=False):
+        loop = asyncio.get_running_loop()
+        if not update:
+            return await loop.run_in_executor(None, self._findpath, dump,
+                                              path, False)
+        # Requests during an update wait for it, then search the index.
+        future = self.updating.get(dump)
+        if future is not None:
+            await future
+            return await loop.run_in_executor(None, self._findpath, dump,
+                                              path, False)
+        started = time.time()
+        future = loop.run_in_executor(None, self._findpath, dump, path, True)
+        self.updating[dump] = future
+        try:
+            location = await future
+        finally:
+            del self.updating[dump]
+        self.indexes[dump] = started
+        return location
+
+    async def op_find(self, request):
+        dump = request.get('dump', self.dump)
+        if dump is None:
+            raise RequestError('no dump folder')
+        dump = os.path.abspath(dump)
+        path = request['path']
+        location = await self._find(dump, path, dump not in self.indexes)
+        updated = self.indexes.get(dump, 0)
+
+        # Archives which changed since the last update are indexed again.
+        # Missing paths only cause a rescan every `RESCAN_INTERVAL` seconds.
+        if location is None:
+            stale = time.time() - updated > RESCAN_INTERVAL
+        else:
+            stale = not os.path.isfile(location[0]) or \
+                os.path.getmtime(location[0]) > updated
+        if stale:
+            location = await self._find(dump, path, True)
+        if location is None:
+            return None
+        return OrderedDict(zip(('archive', 'offset', 'length'), location))
+
+    async def op_stats(self, request):
+        cache = self.cache
+        stats = OrderedDict(cache.stats)
+        stats['tables'] = [list(key) for key in cache.entries]
+        stats['size'] = cache.size
+        stats['budget'] = cache.budget
+        return stats
+
+
+def query(request, socket_path=None, port=None):
+    """Send a request object to a running server. Return its response."""
+    if port is not None:
+        connection = socket.create_connection(('127.0.0.1', port))
+    else:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(socket_path or default_socket_path())
+    with connection, connection.makefile('rwb') as file:
+        file.write(json.dumps(request).encode('utf-8') + b'\n')
+        file.flush()
+        return json.loads(file.readline().decode('utf-8'))
+
+
+def main(argv=None):
+    """Entry point of the `daemon` command."""
+    parser = argparse.ArgumentParser(prog='scr.py daemon',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('-s', '--socket', default=None,
+                        help='Unix socket path (default: {})'.format(
+                            default_socket_path()))
+    parser.add_argument('-p', '--port', type=int, default=None,
+                        help='serve on this localhost TCP port instead')
+    parser.add_argument('-m', '--memory', type=int,
+                        default=MEMORY_BUDGET // 0x100000,
+                        help='memory budget of loaded tables, in MB')
+    parser.add_argument('-d', '--dump', default=None,
+                        help='default folder of archives of find requests')
+    parser.add_argument('-q', '--query', default=None, metavar='JSON',
+                        help='send a request to a running server and print '
+                             'the response')
+    instrument.add_argument(parser)
+    args = parser.parse_args(argv)
+    instrument.setup(args)
+    port = args.port
+    if port is None and not hasattr(socket, 'AF_UNIX'):
+        port = 8765
+
+    if args.query is not None:
+        response = query(json.loads(args.query), args.socket, port)
+        print(json.dumps(response, indent=2, ensure_ascii=False))
+        return 0 if response.get('ok') else 1
+
+    server = Server(args.memory * 0x100000, args.dump)
+    if hasattr(signal, 'SIGTERM'):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        asyncio.run(server.serve(args.socket or default_socket_path(), port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        instrument.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+"""Compare Fantasy Life tables between two dumps, e.g. two game versions.
+
+Rows are compared as raw data first, with their strings if the string data \
+of the two files differs. Only rows which differ are decoded, to report the \
+columns which changed.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import io
+import os
+import sys
+from collections import namedtuple
+from difflib import SequenceMatcher
+
+from . import instrument
+from .scr import TableManager, _iterpaths, load
+from .table import _fieldspecs, newrowclass
+
+
+ADDED = 'added'
+REMOVED = 'removed'
+CHANGED = 'changed'
+
+# Row indices are None for the missing side of added and removed rows.
+# `fields` is a list of (column name, old value, new value) of changed rows,
+# or the decoded row of added and removed rows.
+RowDiff = namedtuple('RowDiff', ['status', 'old_index', 'new_index', 'fields'])
+
+
+def _stringregion(scr):
+    """Return the offset where strings start, and the string data."""
+    start = scr.table_offset + scr.row_count * scr.row_length
+    return start, scr.raw[start:]
+
+
+def _unpackrows(scr, Row):
+    """Return unpacked data of all rows."""
+    unpack_from = Row.struct_obj.unpack_from
+    return [unpack_from(scr.raw, scr.table_offset + row_index * scr.row_length)
+            for row_index in range(scr.row_count)]
+
+
+def _strings(scr):
+    """Return a function which returns the string at an offset, decoded \
+    once per offset.
+    """
+    cache = {}
+
+    def getstring(offset):
+        try:
+            return cache[offset]
+        except KeyError:
+            string = cache[offset] = scr.getstring(offset)
+            return string
+    return getstring
+
+
+def _pairs(oldkeys, newkeys):
+    """Align two lists of row keys, like `difflib` aligns lines.
+
+    Yield tuples of (old index, new index), with None for added and removed \
+    rows. Rows in replaced blocks are paired in order.
+    """
+    # `SequenceMatcher` is quadratic in repeated keys, so equal rows at
+    # both ends are paired first.
+    end = min(len(oldkeys), len(newkeys))
+    start = 0
+    while start < end and oldkeys[start] == newkeys[start]:
+        start += 1
+    stop = 0
+    while stop < end - start and oldkeys[-1 - stop] == newkeys[-1 - stop]:
+        stop += 1
+    for i in range(start):
+        yield i, i
+
+    matcher = SequenceMatcher(None, oldkeys[start:len(oldkeys) - stop],
+                              newkeys[start:len(newkeys) - stop],
+                              autojunk=False)
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        i1, i2, j1, j2 = i1 + start, i2 + start, j1 + start, j2 + start
+        if tag == 'equal':
+            for offset in range(i2 - i1):
+                yield i1 + offset, j1 + offset
+            continue
+        paired = min(i2 - i1, j2 - j1)
+        for offset in range(paired):
+            yield i1 + offset, j1 + offset
+        for i in range(i1 + paired, i2):
+            yield i, None
+        for j in range(j1 + paired, j2):
+            yield None, j
+    for offset in range(stop, 0, -1):
+        yield len(oldkeys) - offset, len(newkeys) - offset
+
+
+def _keypairs(oldkeys, newkeys):
+    """Pair rows which have the same key. See `_pairs`.
+
+    Rows with a duplicate key are paired in order.
+    """
+    positions = {}
+    for j, key in enumerate(newkeys):
+        positions.setdefault(key, []).append(j)
+    for indices in positions.values():
+        indices.reverse()
+    for i, key in enumerate(oldkeys):
+        indices = positions.get(key)
+        yield i, indices.pop() if indices else None
+    for indices in positions.values():
+        for j in reversed(indices):
+            yield None, j
+
+
+def diff_scr(old, new, Row, key=None):
+    """Compare two versions of a table.
+
+    Params:
+    * `old`, `new`: `SCR` objects.
+    * `Row`: Row class of the table.
+    * `key`: Optional name of a non-string column identifying rows, such as \
+      an ID. By default, rows are aligned by their content, like `difflib` \
+      aligns lines.
+
+    Return a list of `RowDiff` objects of added, removed and changed rows.
+    """
+    specs = _fieldspecs(Row)
+    stringindices = [rawindex for kind, rawindex, _ in specs if kind == 'str']
+    oldrows = newrows = None
+    if key is not None or stringindices:
+        oldrows = _unpackrows(old, Row)
+        newrows = _unpackrows(new, Row)
+
+    # String offsets are comparable when string data is identical, at the
+    # same position, so rows are compared as raw bytes. Otherwise, string
+    # offsets are replaced by their strings, which also keeps rows distinct
+    # for alignment.
+    samestrings = not stringindices or \
+        _stringregion(old) == _stringregion(new)
+    if samestrings:
+        oldkeys = [bytes(bytes_obj) for bytes_obj in old.iterrowbytes()]
+        newkeys = [bytes(bytes_obj) for bytes_obj in new.iterrowbytes()]
+    else:
+        def keys(scr, rows):
+            getstring = _strings(scr)
+            return [tuple(getstring(value) if rawindex in stringindices
+                          else value for rawindex, value in enumerate(row))
+                    for row in rows]
+        oldkeys, newkeys = keys(old, oldrows), keys(new, newrows)
+
+    if key is None:
+        pairs = _pairs(oldkeys, newkeys)
+    else:
+        kind, rawindex, _ = specs[Row._fields.index(key)]
+        if kind in ('str', 'bit'):
+            raise ValueError('key column {!r} must not be a string or a bit '
+                             'column'.format(key))
+        pairs = _keypairs([row[rawindex] for row in oldrows],
+                          [row[rawindex] for row in newrows])
+
+    diffs = []
+    for i, j in pairs:
+        if j is None:
+            diffs.append(RowDiff(REMOVED, i, None, _decode(old, Row, i)))
+        elif i is None:
+            diffs.append(RowDiff(ADDED, None, j, _decode(new, Row, j)))
+        elif oldkeys[i] != newkeys[j]:
+            oldrow = _decode(old, Row, i)
+            newrow = _decode(new, Row, j)
+            fields = [(name, oldvalue, newvalue) for name, oldvalue, newvalue
+                      in zip(Row._fields, oldrow, newrow)
+                      if oldvalue != newvalue]
+            if fields:
+                diffs.append(RowDiff(CHANGED, i, j, fields))
+    return diffs
+
+
+def _decode(scr, Row, row_index):
+    """Decode a row, with its strings."""
+    offset = scr.table_offset + row_index * scr.row_length
+    return Row.feed(scr.raw[offset:offset + scr.row_length],
+                    get_string_hook=scr.getstring)
+
+
+def _diffpaths(args):
+    """Compare a table in two dumps. Return a list of `RowDiff` objects, or \
+    None if the table is missing in either dump.
+    """
+    name, _, info, oldpath, newpath, key = args
+    if not (os.path.isfile(oldpath) and os.path.isfile(newpath)):
+        return None
+    with instrument.stage('diff.table') as stage:
+        old = load(oldpath)
+        new = load(newpath)
+        diffs = diff_scr(old, new, newrowclass(info, name), key)
+        stage.add(rows=max(old.row_count, new.row_count))
+    return diffs
+
+
+def _pooled_diffpaths(args):
+    """Run `_diffpaths` in a worker process, and add its statistics.
+
+    Rows are sent back as tuples, because row classes cannot be pickled.
+    """
+    diffs = _diffpaths(args)
+    if diffs is not None:
+        diffs = [diff._replace(fields=tuple(diff.fields)) for diff in diffs]
+    return diffs, instrument.collect()
+
+
+def diff_tables(oldroot, newroot, names=None, languages=None, key=None,
+                jobs=1, manager=None):
+    """Compare tables of two dumps.
+
+    Table paths in tables.json are resolved from `oldroot` and `newroot`.
+
+    Params:
+    * `names`: Table names. By default, all tables.
+    * `languages`: Language codes, the first table parameter. By default, \
+      all languages.
+    * `key`: Optional key column of all tables, see `diff_scr`. Tables \
+      without this column are aligned by content.
+    * `jobs`: Number of worker processes.
+    * `manager`: Optional `TableManager` object.
+
+    Yield tuples of (table name, table parameters joined by '/', e.g. 'en' or \
+    'en/2', list of `RowDiff` objects, or None if the table file is missing \
+    in either dump), in table order.
+    """
+    manager = manager or TableManager()
+    tasks = []
+    for name in names or list(manager.tables):
+        info = manager.tables[name]
+        Row = newrowclass(info, name,
+                          (TableManager.compiled or {}).get(name))
+        tablekey = key if key in Row._fields else None
+        for args, path in _iterpaths(info['paths']):
+            if languages and args[0] not in languages:
+                continue
+            tasks.append((name, args, info, os.path.join(oldroot, path),
+                          os.path.join(newroot, path), tablekey))
+
+    if jobs <= 1:
+        for task in tasks:
+            yield task[0], '/'.join(task[1]), _diffpaths(task)
+        return
+
+    import multiprocessing
+    pool = multiprocessing.Pool(jobs, instrument.reset)
+    try:
+        for task, (diffs, stats) in zip(tasks, pool.imap(_pooled_diffpaths,
+                                                         tasks)):
+            instrument.merge(stats)
+            yield task[0], '/'.join(task[1]), diffs
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _format(value):
+    if isinstance(value, bytes):
+        return value.hex() if hasattr(value, 'hex') else \
+            value.encode('hex')
+    return '{}'.format(value).replace('\t', '\\t').replace('\n', '\\n')
+
+
+def main(argv=None):
+    """Entry point of the `diff` command."""
+    parser = argparse.ArgumentParser(prog='scr.py diff',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('old', help='folder of the old dump')
+    parser.add_argument('new', help='folder of the new dump')
+    parser.add_argument('-t', '--table', nargs='*', default=None,
+                        help='table names (default: all tables)')
+    parser.add_argument('-l', '--language', nargs='*', default=None,
+                        help='language codes (default: all languages)')
+    parser.add_argument('-k', '--key', default=None,
+                        help='column identifying rows, in tables which have it')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes')
+    parser.add_argument('-o', '--out', default=None,
+                        help='write differences to this file (default: stdout)')
+    instrument.add_argument(parser)
+    args = parser.parse_args(argv)
+    instrument.setup(args)
+
+    if args.out:
+        out = io.open(args.out, 'w', encoding='utf-8')
+    else:
+        out = sys.stdout
+    counts = {ADDED: 0, REMOVED: 0, CHANGED: 0}
+    try:
+        for name, language, diffs in diff_tables(
+                args.old, args.new, args.table, args.language, args.key,
+                args.jobs):
+            if diffs is None:
+                print('{}\t{}\tmissing'.format(name, language), file=out)
+                continue
+            for diff in diffs:
+                counts[diff.status] += 1
+                prefix = '{}\t{}\t{}\t{}\t{}'.format(
+                    name, language, diff.status,
+                    '' if diff.old_index is None else diff.old_index,
+                    '' if diff.new_index is None else diff.new_index)
+                if diff.status == CHANGED:
+                    for column, oldvalue, newvalue in diff.fields:
+                        print('{}\t{}\t{}\t{}'.format(
+                            prefix, column, _format(oldvalue),
+                            _format(newvalue)), file=out)
+                else:
+                    print('{}\t\t{}'.format(prefix, '\t'.join(
+                        _format(value) for value in diff.fields)), file=out)
+    finally:
+        if args.out:
+            out.close()
+    sys.stderr.write('{} rows added, {} removed, {} changed\n'.format(
+        counts[ADDED], counts[REMOVED], counts[CHANGED]))
+    instrument.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
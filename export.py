@@ -0,0 +1,190 @@
+#!/usr/bin/env python
+"""Export Fantasy Life tables to an SQLite database."""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import sqlite3
+import sys
+
+from . import instrument
+from .scr import TableManager, _iterpaths
+from .table import _fieldspecs, newrowclass
+
+
+BATCH_SIZE = 0x1000  # Rows per executemany call
+
+
+def _quote(identifier):
+    """Quote an SQL identifier."""
+    return '"{}"'.format(identifier.replace('"', '""'))
+
+
+def _isindexed(name, info):
+    """Return True if column `name` should be indexed.
+
+    ID columns (named 'id', or ending with '_id' or 'Id'), string columns \
+    and columns with an "index": true key in tables.json are indexed.
+    """
+    if info is not None and info.get('index'):
+        return True
+    lower = name.lower()
+    return lower == 'id' or lower.endswith('_id') or name.endswith('Id') or \
+        (info is not None and info.get('type') == 'str')
+
+
+def _columns(Row):
+    """Return a list of (name, SQL type, column info or None) of a row class."""
+    columns = []
+    specs = _fieldspecs(Row)
+    info = None
+    for name, (kind, rawindex, arg) in zip(Row._fields, specs):
+        if kind != 'bit':
+            info = Row.columns[rawindex]
+        if kind == 'bit':
+            columns.append((name, 'INTEGER', None))
+        elif kind == 'str':
+            columns.append((name, 'INTEGER REFERENCES strings (id)', info))
+        elif kind == 'enum':
+            columns.append((name, 'TEXT', info))
+        elif info['type'] == 'gap':
+            columns.append((name, 'BLOB', None))
+        elif info['type'] == 'f32':
+            columns.append((name, 'REAL', info))
+        else:
+            columns.append((name, 'INTEGER', info))
+    return columns
+
+
+def export_sqlite(dbpath, names=None, manager=None, progress=None):
+    """Export tables of all languages to an SQLite database.
+
+    Each table is stored in an SQL table of the same name, with a \
+    `language` and a `row` column in front of its own columns. Strings are \
+    stored once in the `strings` table, and string columns hold their id. \
+    A `<table>_text` view joins the strings back. Tables with several \
+    parameters have all of them in `language`, joined by '/', e.g. 'en/2'. \
+    Tables without columns in tables.json cannot be exported.
+
+    Params:
+    * `dbpath`: Database path. Existing tables are replaced.
+    * `names`: Table names. If None, export all tables.
+    * `manager`: A `TableManager` object.
+    * `progress`: Optional callable, called with (table name, language) \
+      after each exported file, and with (table name, None) for each table \
+      which cannot be exported.
+
+    Return the number of exported rows.
+    """
+    manager = manager or TableManager()
+    if names is None:
+        names = list(manager.tables)
+    connection = sqlite3.connect(dbpath)
+    connection.execute('PRAGMA synchronous = OFF')
+    connection.execute('PRAGMA journal_mode = MEMORY')
+    connection.execute('CREATE TABLE IF NOT EXISTS strings '
+                       '(id INTEGER PRIMARY KEY, text TEXT UNIQUE NOT NULL)')
+    string_ids = dict((text, string_id) for string_id, text in
+                      connection.execute('SELECT id, text FROM strings'))
+    new_strings = []
+
+    def string_id(text):
+        try:
+            return string_ids[text]
+        except KeyError:
+            string_ids[text] = len(string_ids) + 1
+            new_strings.append((string_ids[text], text))
+            return string_ids[text]
+
+    row_count = 0
+    for name in names:
+        info = manager.tables[name]
+        if not info['columns']:
+            if progress is not None:
+                progress(name, None)
+            continue
+        Row = newrowclass(info, name, (manager.compiled or {}).get(name))
+        columns = _columns(Row)
+        string_fields = [i for i, (_, _, column) in enumerate(columns)
+                         if column is not None and column['type'] == 'str']
+        # Python 2 binds byte strings as text, so gaps are made binary.
+        blob_fields = [i for i, (_, sqltype, _) in enumerate(columns)
+                       if sqltype == 'BLOB']
+        table = _quote(name)
+
+        with connection:
+            connection.execute('DROP VIEW IF EXISTS ' + _quote(name + '_text'))
+            connection.execute('DROP TABLE IF EXISTS ' + table)
+            connection.execute('CREATE TABLE {} (language TEXT NOT NULL, '
+                'row INTEGER NOT NULL, {}, PRIMARY KEY (language, row))'.format(
+                    table, ', '.join('{} {}'.format(_quote(column), sqltype)
+                                     for column, sqltype, _ in columns)))
+            insert = 'INSERT INTO {} VALUES ({})'.format(
+                table, ', '.join('?' * (len(columns) + 2)))
+
+            for args, _ in _iterpaths(info['paths']):
+                language = '/'.join(args)
+                rows = manager.loadtable(name, *args)
+                row_count += len(rows)
+                batch = []
+                for row_index, row in enumerate(rows):
+                    values = [language, row_index]
+                    values.extend(row)
+                    for field in string_fields:
+                        values[field + 2] = string_id(values[field + 2])
+                    for field in blob_fields:
+                        values[field + 2] = sqlite3.Binary(values[field + 2])
+                    batch.append(values)
+                    if len(batch) >= BATCH_SIZE:
+                        connection.executemany(insert, batch)
+                        batch = []
+                connection.executemany(insert, batch)
+                connection.executemany('INSERT INTO strings VALUES (?, ?)',
+                                       new_strings)
+                del new_strings[:]
+                if progress is not None:
+                    progress(name, language)
+
+            for column, _, column_info in columns:
+                if _isindexed(column, column_info):
+                    connection.execute('CREATE INDEX {} ON {} ({})'.format(
+                        _quote('{}_{}'.format(name, column)), table,
+                        _quote(column)))
+            connection.execute('CREATE VIEW {} AS SELECT language, row, {} '
+                'FROM {} AS t {}'.format(
+                    _quote(name + '_text'),
+                    ', '.join('s{0}.text AS {1}'.format(i, _quote(column))
+                              if i in string_fields else
+                              't.' + _quote(column)
+                              for i, (column, _, _) in enumerate(columns)),
+                    table,
+                    ' '.join('LEFT JOIN strings AS s{0} ON s{0}.id = t.{1}'
+                             .format(i, _quote(columns[i][0]))
+                             for i in string_fields)))
+    connection.close()
+    return row_count
+
+
+def main(argv=None):
+    """Entry point of the `export-sqlite` command."""
+    parser = argparse.ArgumentParser(prog='scr.py export-sqlite')
+    parser.add_argument('out', help='path to SQLite database')
+    parser.add_argument('-t', '--table', nargs='*', default=None,
+                        help='table names (default: all tables)')
+    instrument.add_argument(parser)
+    args = parser.parse_args(argv)
+    instrument.setup(args)
+
+    def progress(name, language):
+        if language is None:
+            print('{} skipped: no columns in tables.json'.format(name))
+        else:
+            print('{} ({})'.format(name, language))
+
+    row_count = export_sqlite(args.out, args.table, progress=progress)
+    print('{} rows exported to {}.'.format(row_count, args.out))
+    instrument.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,245 @@
+"""Opt-in timing of the stages of archive and SCR processing.
+
+Instrumentation is disabled by default, and stages then cost one function \
+call. It is enabled by `enable`, usually through the `--profile` option of \
+arc.py and scr.py, or by setting the `FLTOOLS_PROFILE` environment variable \
+to the path of the JSON summary ('-' for standard error). Set \
+`FLTOOLS_CPROFILE` to a path to also dump cProfile statistics there.
+
+Stages may nest: string decoding is also counted in the stage which \
+requested the strings.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import os
+import sys
+from collections import OrderedDict
+from timeit import default_timer
+
+
+ENV_SUMMARY = 'FLTOOLS_PROFILE'
+ENV_CPROFILE = 'FLTOOLS_CPROFILE'
+
+enabled = False
+_stats = {}  # Stage name: [calls, seconds, bytes, rows, strings]
+_counters = {}  # Counter name: value
+_profiler = None
+
+
+class _Stage(object):
+    """Context manager which adds its wall time to a stage."""
+    __slots__ = ('name', 'start', 'bytes', 'rows', 'strings')
+
+    def __init__(self, name):
+        self.name = name
+        self.bytes = self.rows = self.strings = 0
+
+    def add(self, bytes=0, rows=0, strings=0):
+        """Count data processed by this stage."""
+        self.bytes += bytes
+        self.rows += rows
+        self.strings += strings
+
+    def __enter__(self):
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        _record(self.name, default_timer() - self.start, self.bytes,
+                self.rows, self.strings)
+
+
+class _NullStage(object):
+    """Stage used while instrumentation is disabled."""
+    __slots__ = ()
+
+    def add(self, bytes=0, rows=0, strings=0):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """Return a context manager timing the stage `name`.
+
+    Use its `add` method to count bytes, rows and strings processed.
+    """
+    if not enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def count(name, value=1):
+    """Add `value` to the counter `name`, if enabled."""
+    if enabled:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def _record(name, seconds, bytes=0, rows=0, strings=0, calls=1):
+    stats = _stats.get(name)
+    if stats is None:
+        stats = _stats[name] = [0, 0.0, 0, 0, 0]
+    stats[0] += calls
+    stats[1] += seconds
+    stats[2] += bytes
+    stats[3] += rows
+    stats[4] += strings
+
+
+def watch(scr):
+    """Count string lookups and time string decoding of an `SCR` object.
+
+    The `getstring` and `_decodestring` methods of this instance are \
+    wrapped, so other instances are not slowed down.
+    """
+    getstring = scr.getstring
+    decodestring = scr._decodestring
+
+    def counted_getstring(offset, tag=False):
+        _counters['strings.lookups'] = _counters.get('strings.lookups', 0) + 1
+        return getstring(offset, tag)
+
+    def timed_decodestring(offset):
+        start = default_timer()
+        result = decodestring(offset)
+        _record('scr.decode', default_timer() - start,
+                result[1] + 2 - offset, strings=1)
+        return result
+
+    scr.getstring = counted_getstring
+    scr._decodestring = timed_decodestring
+
+
+def snapshot():
+    """Return the statistics of this process, which can be `merge`d."""
+    if not enabled:
+        return None
+    return {'stages': dict((name, list(stats))
+                           for name, stats in _stats.items()),
+            'counters': dict(_counters)}
+
+
+def merge(data):
+    """Add statistics returned by `snapshot` in another process."""
+    if not data:
+        return
+    for name, (calls, seconds, bytes, rows, strings) in \
+            data['stages'].items():
+        _record(name, seconds, bytes, rows, strings, calls)
+    for name, value in data['counters'].items():
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def reset():
+    """Clear all statistics."""
+    _stats.clear()
+    _counters.clear()
+
+
+def collect():
+    """Return `snapshot`, and clear all statistics.
+
+    Worker processes return this with each result, so that statistics are \
+    merged once.
+    """
+    data = snapshot()
+    reset()
+    return data
+
+
+def summary():
+    """Return all statistics as an OrderedDict, ready for JSON.
+
+    String cache hits are lookups which did not decode a string, either \
+    from the string cache or from predecoded strings.
+    """
+    stages = OrderedDict()
+    for name in sorted(_stats, key=lambda name: -_stats[name][1]):
+        calls, seconds, bytes, rows, strings = _stats[name]
+        stage = stages[name] = OrderedDict([
+            ('calls', calls), ('seconds', round(seconds, 6))])
+        for key, value in (('bytes', bytes), ('rows', rows),
+                           ('strings', strings)):
+            if value:
+                stage[key] = value
+                if seconds:
+                    stage[key + '_per_second'] = round(value / seconds, 1)
+    result = OrderedDict([('stages', stages)])
+
+    lookups = _counters.get('strings.lookups', 0)
+    if lookups:
+        decoded = _stats.get('scr.decode', [0])[0]
+        predecoded = _counters.get('strings.predecoded', 0)
+        hits = max(lookups - (decoded - predecoded), 0)
+        result['string_cache'] = OrderedDict([
+            ('lookups', lookups), ('hits', hits),
+            ('hit_rate', round(hits / lookups, 4))])
+    result['counters'] = OrderedDict(sorted(_counters.items()))
+    return result
+
+
+def enable(summary_path='-', cprofile_path=None):
+    """Enable instrumentation, and start cProfile if `cprofile_path` is set.
+
+    The paths are also stored in the environment, so that worker processes \
+    are instrumented too.
+    """
+    global enabled, _profiler
+    enabled = True
+    os.environ[ENV_SUMMARY] = summary_path or '-'
+    if cprofile_path:
+        os.environ[ENV_CPROFILE] = cprofile_path
+        if _profiler is None:
+            import cProfile
+            _profiler = cProfile.Profile()
+            _profiler.enable()
+
+
+def report():
+    """Write the JSON summary and the cProfile dump, if enabled."""
+    global _profiler
+    if not enabled:
+        return
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(os.environ[ENV_CPROFILE])
+        _profiler = None
+    import json
+    text = json.dumps(summary(), indent=2)
+    path = os.environ.get(ENV_SUMMARY, '-')
+    if path in ('', '-', '1'):
+        sys.stderr.write(text + '\n')
+    else:
+        with open(path, 'w') as file:
+            file.write(text + '\n')
+
+
+def add_argument(parser):
+    """Add the `--profile` and `--cprofile` options to an argument parser."""
+    parser.add_argument(
+        '--profile', nargs='?', const='-', default=None, metavar='PATH',
+        help='write a JSON summary of stage timings to PATH (default: stderr)')
+    parser.add_argument('--cprofile', default=None, metavar='PATH',
+                        help='with --profile, dump cProfile stats to PATH')
+
+
+def setup(args):
+    """Enable instrumentation from parsed `add_argument` options."""
+    if args.profile is not None:
+        enable(args.profile, args.cprofile)
+
+
+if os.environ.get(ENV_SUMMARY):
+    enabled = True
+    if os.environ.get(ENV_CPROFILE):
+        # Only the main process dumps cProfile statistics.
+        import multiprocessing
+        if multiprocessing.current_process().name == 'MainProcess':
+            enable(os.environ[ENV_SUMMARY], os.environ[ENV_CPROFILE])
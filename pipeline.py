@@ -0,0 +1,273 @@
+#!/usr/bin/env python
+"""Dump SCR files inside archives, without extracting the archives first.
+
+Archives are read in the main process. SCR members are detected in memory, \
+like `scr.load` does, and sent through a bounded queue to worker processes, \
+which write their text dumps.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import os
+import sys
+from fnmatch import fnmatch
+from struct import error as struct_error
+try:
+    from queue import Empty, Full
+except ImportError:
+    from Queue import Empty, Full
+
+from . import instrument
+from .arc import Arc, InvalidFileError, _outpath, _release
+from .catalog import ARC, open_catalog
+from .scr import SCR, scroffset, writelines
+
+
+QUEUE_SIZE = 64  # Default number of members waiting for a worker
+POLL_INTERVAL = 1  # Seconds between checks that workers are still running
+
+
+def iterpaths(path, catalog=None):
+    """Yield `path` if it is a file, or all files in the folder `path`.
+
+    With a `Catalog` object of the folder, only yield archives.
+    """
+    if os.path.isfile(path):
+        yield path
+        return
+    if catalog is not None:
+        for filepath in catalog.paths(ARC):
+            yield filepath
+        return
+    for dirpath, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            yield os.path.join(dirpath, filename)
+
+
+def itermembers(paths, pattern=None):
+    """Yield SCR files inside archives.
+
+    Params:
+    * `paths`: Iterable of file paths. Files which are not archives are \
+      skipped.
+    * `pattern`: Optional shell-style pattern of internal paths.
+
+    Yield tuples of (archive path, internal path, SCR data). SCR data is a \
+    bytes object, without the 0x10-byte header some members have.
+    """
+    for filepath in paths:
+        try:
+            bin = Arc(filepath, use_mmap=True)
+        except (InvalidFileError, TypeError, struct_error):
+            continue
+        with bin:
+            for file_index, entry in enumerate(bin.file_entries):
+                if pattern is not None and not fnmatch(entry.path, pattern):
+                    continue
+                data = bin.getdata(file_index)
+                try:
+                    offset = scroffset(bytes(data[:0x14]))
+                    member = None if offset is None else bytes(data[offset:])
+                finally:
+                    _release(data)
+                if member is not None:
+                    yield filepath, entry.path, member
+
+
+def dumpmember(outdir, path, raw, string_offsets=(), struct=None):
+    """Write the text dump of an SCR member, like `scr.py -f` does.
+
+    The dump is written to `<outdir>/<internal path without extension>\
+    _table.txt`. Return its path and the number of rows.
+    """
+    scr = SCR(raw)
+    outpath = os.path.splitext(_outpath(outdir, path))[0] + '_table.txt'
+    outsubdir = os.path.dirname(outpath)
+    if outsubdir and not os.path.isdir(outsubdir):
+        try:
+            os.makedirs(outsubdir)
+        except OSError: # Created by another worker
+            if not os.path.isdir(outsubdir):
+                raise
+    with instrument.stage('scr.dump') as stage:
+        writelines(outpath, scr.iterlines(struct, string_offsets))
+        stage.add(rows=scr.row_count)
+    return outpath, scr.row_count
+
+
+def _dump(member, outdir, string_offsets, struct):
+    """Dump a member. Return (internal path, row count, error message)."""
+    path = member[1]
+    try:
+        return path, dumpmember(outdir, path, member[2], string_offsets,
+                                struct)[1], None
+    except Exception as e: # One broken member must not stop the others.
+        return path, 0, '{}: {}'.format(type(e).__name__, e)
+
+
+def _worker(worker_index, inqueue, outqueue, outdir, string_offsets,
+            struct):
+    """Dump members from `inqueue` until None, in a worker process.
+
+    Results are put in `outqueue`, then (None, worker index, statistics).
+    """
+    instrument.reset()
+    for member in iter(inqueue.get, None):
+        outqueue.put(_dump(member, outdir, string_offsets, struct))
+    outqueue.put((None, worker_index, instrument.collect()))
+
+
+def _put(inqueue, item, workers):
+    """Put `item` in `inqueue`, unless all workers exited."""
+    while True:
+        try:
+            inqueue.put(item, timeout=POLL_INTERVAL)
+            return
+        except Full:
+            if not any(worker.is_alive() for worker in workers):
+                raise RuntimeError('all dump workers exited')
+
+
+def run(path, outdir, jobs=1, queue_size=QUEUE_SIZE, pattern=None,
+        string_offsets=(), struct=None, progress=None, catalog=None):
+    """Dump all SCR members of the archives in `path`.
+
+    Params:
+    * `path`: An archive, or a folder of archives.
+    * `outdir`: Output folder.
+    * `jobs`: Number of worker processes. With 1, members are dumped in \
+      the main process.
+    * `queue_size`: Maximum number of members read but not dumped yet, \
+      which bounds memory use.
+    * `pattern`: Optional shell-style pattern of internal paths.
+    * `string_offsets`, `struct`: Dump options, see `SCR.iterlines`.
+    * `progress`: Optional callable, called with (dumped member count, \
+      row count, internal path) after each member.
+    * `catalog`: Optional `Catalog` object of the folder `path`.
+
+    Return a tuple of (dumped member count, row count, list of (internal \
+    path, error message) of members which could not be dumped). A worker \
+    which exits unexpectedly is reported as an error, with a path of None: \
+    the member it was dumping, and results it did not send yet, are lost.
+    """
+    members = itermembers(iterpaths(path, catalog), pattern)
+    counts = [0, 0]
+    errors = []
+
+    def collect(result):
+        path, row_count, error = result
+        if error is not None:
+            errors.append((path, error))
+            return
+        counts[0] += 1
+        counts[1] += row_count
+        if progress is not None:
+            progress(counts[0], counts[1], path)
+
+    if jobs <= 1:
+        for member in members:
+            collect(_dump(member, outdir, string_offsets, struct))
+        return counts[0], counts[1], errors
+
+    import multiprocessing
+    inqueue = multiprocessing.Queue(queue_size)
+    outqueue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(
+                   target=_worker,
+                   args=(worker_index, inqueue, outqueue, outdir,
+                         string_offsets, struct))
+               for worker_index in range(jobs)]
+    for worker in workers:
+        worker.start()
+    finished = set()
+
+    def handle(result):
+        if result[0] is None:
+            instrument.merge(result[2])
+            finished.add(result[1])
+        else:
+            collect(result)
+
+    def drain():
+        while True:
+            try:
+                handle(outqueue.get_nowait())
+            except Empty:
+                return
+
+    try:
+        for member in members:
+            # Blocks while the queue is full.
+            _put(inqueue, member, workers)
+            drain()
+        for _ in workers:
+            _put(inqueue, None, workers)
+        while len(finished) < jobs:
+            try:
+                result = outqueue.get(timeout=POLL_INTERVAL)
+            except Empty:
+                # Results of exited workers are all in the queue already,
+                # so workers without a final record after draining it died.
+                exited = [worker_index for worker_index, worker
+                          in enumerate(workers) if not worker.is_alive()]
+                drain()
+                for worker_index in exited:
+                    if worker_index not in finished:
+                        finished.add(worker_index)
+                        exitcode = workers[worker_index].exitcode
+                        errors.append((None, 'worker exited with code {}'
+                                       .format(exitcode)))
+                continue
+            handle(result)
+    except BaseException:
+        for worker in workers:
+            worker.terminate()
+        raise
+    finally:
+        for worker in workers:
+            worker.join()
+    return counts[0], counts[1], errors
+
+
+def _printprogress(member_count, row_count, path):
+    sys.stderr.write('\r{} files, {} rows'.format(member_count, row_count))
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    """Entry point of the `pipeline` command."""
+    parser = argparse.ArgumentParser(prog='scr.py pipeline',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('path', nargs='?', default='archive\\bin',
+                        help='archive, or folder of archives')
+    parser.add_argument('-o', '--out', default='dump', help='output folder')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of dump worker processes')
+    parser.add_argument('-q', '--queue', type=int, default=QUEUE_SIZE,
+                        help='maximum number of members waiting for a worker')
+    parser.add_argument('-m', '--match', default=None,
+                        help='only dump internal paths matching this pattern')
+    parser.add_argument('--str', nargs='*', help='string offsets (relative)')
+    parser.add_argument('--struct', default=None,
+                        help='Python struct format string')
+    instrument.add_argument(parser)
+    args = parser.parse_args(argv)
+    instrument.setup(args)
+
+    string_offsets = [int(x) for x in args.str or ()]
+    catalog = open_catalog(args.path) if os.path.isdir(args.path) else None
+    member_count, row_count, errors = run(
+        args.path, args.out, args.jobs, args.queue, args.match,
+        string_offsets, args.struct, _printprogress, catalog)
+    sys.stderr.write('\n')
+    for path, error in errors:
+        print(error if path is None else '{}: {}'.format(path, error))
+    print('{} files dumped, {} rows, {} errors'.format(
+        member_count, row_count, len(errors)))
+    instrument.report()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -5,23 +5,34 @@ Compatible with Python 2 and 3.
 """
 
 from __future__ import division, print_function, unicode_literals
-import argparse
 import io
-import json
 import os
+import re
 import sys
 from binascii import hexlify
+from codecs import utf_16_le_decode as _utf_16_le_decode
 from collections import OrderedDict, namedtuple
-from struct import calcsize, pack, unpack
+from functools import partial
+from struct import Struct, calcsize, pack, unpack, unpack_from, \
+    error as struct_error
 try:
     from itertools import izip as zip
 except ImportError:
     pass
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
-from .table import Table, newrowclass
+from . import instrument
+from .table import ColumnarTable, LazyTable, MultiLangTable, Table, \
+    compilerow, loadarray, newrowclass
 
 
 DEBUG = True
+STRING_CACHE_SIZE = 0x2000  # Default number of strings cached by each SCR
+WRITE_BUFFER_SIZE = 0x100000  # Buffer size of text dumps
+SCHEMA_CACHE_VERSION = 2  # Bump when the compiled schema format changes
 
 ###############################################################################
 # SCR
@@ -29,14 +40,14 @@ DEBUG = True
 class TableManager(object):
     """Manage all tables in Fantasy Life game."""
     tables = None
+    compiled = None
 
     def __init__(self):
         if TableManager.tables is None:
             path = os.path.join(os.path.dirname(__file__), 'tables.json')
-            with open(path, 'r') as file:
-                TableManager.tables = json.load(file, object_pairs_hook=OrderedDict)
+            TableManager.tables, TableManager.compiled = _loadschemas(path)
 
-    def loadtable(self, name, *args):
+    def loadtable(self, name, *args, **kwargs):
         """Load a table.
 
         Params:
@@ -44,31 +55,77 @@ class TableManager(object):
         * `*args`: List of table parameters. The first parameters is language \
           in most case. If no table parameter specified, return all tables \
           in an OrderedDict object.
+        * `predecode`: If True, decode the whole string region of each file \
+          once before reading rows.
+        * `backend`: 'rows' (default) returns `Table` objects. 'numpy' \
+          returns `ArrayTable` objects, which requires NumPy. 'lazy' \
+          returns `LazyTable` objects, which decode fields on access. \
+          'columnar' returns `ColumnarTable` objects, which store columns \
+          in arrays and rebuild rows on access.
+        * `jobs`: When loading all tables of the 'rows' backend, number of \
+          worker processes loading files concurrently.
+        * `lazy`: When loading all tables, return a `LazyTables` object, \
+          which loads each table on first access.
+        * `multilang`: When loading all tables, return a `MultiLangTable` \
+          object, which stores non-string columns once and checks that \
+          they match across languages.
         """
+        predecode = kwargs.pop('predecode', False)
+        backend = kwargs.pop('backend', 'rows')
+        jobs = kwargs.pop('jobs', 1)
+        lazy = kwargs.pop('lazy', False)
+        multilang = kwargs.pop('multilang', False)
+        if kwargs:
+            raise TypeError('unexpected keyword argument {!r}'
+                            .format(next(iter(kwargs))))
+
         info = TableManager.tables[name]
-        Row = newrowclass(info)
+        Row = newrowclass(info, name, (TableManager.compiled or {}).get(name))
         filepaths = info['paths']
         if len(args) > 0:
             for arg in args:
                 filepaths = filepaths[arg]
-            with open(filepaths, 'rb') as file:
-                scrfile = SCR(file.read())
-            table = Table()
-            for bytes_obj in scrfile.iterrowbytes():
-                row = Row.feed(bytes_obj, get_string_hook=scrfile.getstring)
-                table.append(row)
+            return _readtable(info, Row, filepaths, predecode, backend)
+
+        elif multilang:
+            table = MultiLangTable(Row)
+            for language, filepath in filepaths.items():
+                scrfile = _readscr(filepath, predecode)
+                with instrument.stage('table.feed') as stage:
+                    table.add(language, (
+                        Row.feed(bytes_obj, get_string_hook=scrfile.getstring)
+                        for bytes_obj in scrfile.iterrowbytes()))
+                    stage.add(rows=scrfile.row_count)
             return table
 
+        elif lazy:
+            return LazyTables(partial(_readtable, info, Row,
+                                      predecode=predecode, backend=backend),
+                              filepaths)
+
+        elif jobs > 1 and backend == 'rows':
+            # Row classes cannot be pickled, so rows are sent back as tuples.
+            import multiprocessing
+            pool = multiprocessing.Pool(min(jobs, len(filepaths)),
+                                        instrument.reset)
+            try:
+                results = pool.map(_loadrows, [
+                    (name, info, filepath, predecode)
+                    for filepath in filepaths.values()])
+            finally:
+                pool.close()
+                pool.join()
+            tables = OrderedDict()
+            for language, (rows, stats) in zip(filepaths, results):
+                instrument.merge(stats)
+                tables[language] = Table(tuple.__new__(Row, row) for row in rows)
+            return tables
+
         else:
             tables = OrderedDict()
             for name, filepath in filepaths.items():
-                with open(filepath, 'rb') as file:
-                    scrfile = SCR(file.read())
-                table = Table()
-                for bytes_obj in scrfile.iterrowbytes():
-                    row = Row.feed(bytes_obj, get_string_hook=scrfile.getstring)
-                    table.append(row)
-                tables[name] = table
+                tables[name] = _readtable(info, Row, filepath, predecode,
+                                          backend)
             return tables
 
     def appendmultiple(self, name, filepath, firstlanguage):
@@ -105,16 +162,150 @@ class TableManager(object):
 
     def save(self):
         """Save table data to file to tables.json."""
+        import json
         with open('tables.json', 'w') as file:
             json.dump(self.tables, file, separators=(',', ': '), indent=4)
 
 
+def _loadschemas(path):
+    """Load tables.json at `path`, with a cache of compiled row structures.
+
+    The cache is stored next to tables.json. It is used as long as the \
+    modification time and size of tables.json match, or its SHA-1 hash \
+    matches. Otherwise tables.json is parsed again, and all row structures \
+    are compiled again with `compilerow`.
+
+    Return a tuple of (tables, compiled row structures by table name).
+    """
+    import hashlib
+    import pickle
+    cachepath = os.path.splitext(path)[0] + '.cache'
+    stat = os.stat(path)
+    try:
+        with open(cachepath, 'rb') as file:
+            cache = pickle.load(file)
+        if cache['version'] != SCHEMA_CACHE_VERSION:
+            cache = None
+    except Exception: # Missing, unreadable or outdated cache
+        cache = None
+    if cache is not None and cache['mtime'] == stat.st_mtime and \
+            cache['size'] == stat.st_size:
+        return cache['tables'], cache['compiled']
+
+    with open(path, 'rb') as file:
+        data = file.read()
+    digest = hashlib.sha1(data).hexdigest()
+    if cache is None or cache['hash'] != digest:
+        import json
+        tables = json.loads(data.decode('utf-8'),
+                            object_pairs_hook=OrderedDict)
+        compiled = {}
+        for name, info in tables.items():
+            try:
+                compiled[name] = compilerow(info)
+            except (KeyError, TypeError, ValueError):
+                pass # Reported when the table is loaded
+        cache = {'version': SCHEMA_CACHE_VERSION, 'hash': digest,
+                 'tables': tables, 'compiled': compiled}
+    cache['mtime'] = stat.st_mtime
+    cache['size'] = stat.st_size
+    try:
+        with open(cachepath, 'wb') as file:
+            pickle.dump(cache, file, pickle.HIGHEST_PROTOCOL)
+    except (IOError, OSError):
+        pass
+    return cache['tables'], cache['compiled']
+
+
+def _iterpaths(paths, args=()):
+    """Yield (table parameters, file path) of nested `paths` of tables.json."""
+    for arg, path in paths.items():
+        if isinstance(path, dict):
+            for item in _iterpaths(path, args + (arg,)):
+                yield item
+        else:
+            yield args + (arg,), path
+
+
+def _readscr(filepath, predecode=False):
+    """Read a whole SCR file."""
+    with instrument.stage('scr.read') as stage, open(filepath, 'rb') as file:
+        raw = file.read()
+        stage.add(bytes=len(raw))
+    return SCR(raw, predecode=predecode)
+
+
+def _readtable(info, Row, filepath, predecode=False, backend='rows'):
+    """Read all rows of an SCR file into a table object."""
+    scrfile = _readscr(filepath, predecode)
+    if backend == 'numpy':
+        with instrument.stage('table.array') as stage:
+            table = loadarray(scrfile, info, Row)
+            stage.add(rows=scrfile.row_count)
+        return table
+    elif backend == 'lazy':
+        return LazyTable(scrfile, Row, get_string_hook=scrfile.getstring)
+    elif backend == 'columnar':
+        with instrument.stage('table.columnar') as stage:
+            table = ColumnarTable(scrfile, Row,
+                                  get_string_hook=scrfile.getstring)
+            stage.add(rows=scrfile.row_count)
+        return table
+    elif backend != 'rows':
+        raise ValueError('unknown backend {!r}'.format(backend))
+
+    with instrument.stage('table.feed') as stage:
+        table = Table(Row.feed(bytes_obj, get_string_hook=scrfile.getstring)
+                      for bytes_obj in scrfile.iterrowbytes())
+        stage.add(rows=scrfile.row_count)
+    return table
+
+
+def _loadrows(args):
+    """Read all rows of an SCR file as plain tuples, in a worker process.
+
+    Return the rows, and the instrumentation statistics of the worker.
+    """
+    name, info, filepath, predecode = args
+    Row = newrowclass(info, name)
+    rows = [tuple(row) for row in _readtable(info, Row, filepath, predecode)]
+    return rows, instrument.collect()
+
+
+class LazyTables(Mapping):
+    """Tables of all languages, each one loaded on first access."""
+
+    def __init__(self, loader, filepaths):
+        """Params:
+        * `loader`: Callable which loads the table at a file path.
+        * `filepaths`: Mapping of languages to file paths.
+        """
+        self.loader = loader
+        self.filepaths = filepaths
+        self.loaded = {}
+
+    def __getitem__(self, language):
+        try:
+            return self.loaded[language]
+        except KeyError:
+            table = self.loader(self.filepaths[language])
+            self.loaded[language] = table
+            return table
+
+    def __iter__(self):
+        return iter(self.filepaths)
+
+    def __len__(self):
+        return len(self.filepaths)
+
+
 class UnsupportedSCRError(TypeError):
     pass
 
 
 class SCR(object):
     """SCR file."""
+    MAGIC = b'\x13\x80\x03\x1D'
     colors = {
         0: 'Black',
         3: 'Red',
@@ -134,91 +325,166 @@ class SCR(object):
         10: 'Y'
     } # There are also big Y, big L and big R button in the images
 
-    def __init__(self, raw):
+    def __init__(self, raw, cache_size=STRING_CACHE_SIZE, predecode=False):
+        """Params:
+        * `raw`: File data, a bytes-like object.
+        * `cache_size`: Maximum number of decoded strings kept by \
+          `getstring`, keyed by offset. 0 disables the cache.
+        * `predecode`: If True, decode the whole string region at once. See \
+          `predecode`.
+        """
         self.raw = raw
         table_info_offset = unpack('<I', self.raw[0x14:0x18])[0]
         self.row_count, self.row_length, self.table_offset = \
             unpack('<3I', self.raw[table_info_offset:table_info_offset + 12])
-    
+        self.cache_size = cache_size
+        self.string_cache = OrderedDict()
+        self.string_pool = None
+        if instrument.enabled:
+            instrument.watch(self)
+        if predecode:
+            self.predecode()
+
+    def predecode(self, start=None, end=None):
+        """Decode all strings between `start` and `end` once.
+
+        By default, the string region starts after the last row and ends at \
+        the end of the file. Strings are decoded one after another, and \
+        stored in `string_pool` by offset. `getstring` looks up this map \
+        first, so offsets outside of it are still decoded on demand.
+        """
+        if start is None:
+            start = self.table_offset + self.row_count * self.row_length
+        if end is None:
+            end = len(self.raw)
+        pool = {}
+        pos = start
+        while pos < end:
+            try:
+                string, string_end = self._decodestring(pos)
+            except (UnicodeDecodeError, struct_error): # Not a string
+                break
+            pool[pos] = string
+            pos = string_end + 2
+        self.string_pool = pool
+        instrument.count('strings.predecoded', len(pool))
+
     def getstring(self, offset, tag=False):
         """Return string at `offset`."""
+        if self.string_pool is not None:
+            string = self.string_pool.get(offset)
+            if string is not None:
+                return string
+        if not self.cache_size:
+            return self._decodestring(offset)[0]
+
+        # Least recently used strings are evicted first.
+        cache = self.string_cache
+        string = cache.pop(offset, None)
+        if string is None:
+            string = self._decodestring(offset)[0]
+            if len(cache) >= self.cache_size:
+                cache.popitem(last=False)
+        cache[offset] = string
+        return string
+
+    def _decodestring(self, offset):
+        """Decode string at `offset`. Return (string, terminator offset)."""
+        raw = self.raw
         pos = offset
         strings = []
         while True:
-            if self.raw[pos:pos + 4] == b'\xE9\xFF\xFF\xFF': # Branch
-                byte_count = unpack('<H', self.raw[pos + 22:pos + 24])[0]
-                pos += 24
-                strings.append(self.raw[pos:pos + byte_count - 2]
-                    .decode('utf-16le'))
-                strings.append(' / ')
-
-                pos += byte_count
-                if self.raw[pos:pos + 2] == b'\xFF\xFF':
-                    pos += 2
-                byte_count = unpack('<H', self.raw[pos + 2:pos + 4])[0]
-                strings.append(self.raw[pos + 4:pos + 2 + byte_count]
-                    .decode('utf-16le'))
-                pos = pos + 4 + byte_count
-
-            elif self.raw[pos:pos + 4] == b'\xF1\xFF\xFF\xFF':
-                # Pause, press A to continue
-                strings.append('\\n')
-                pos = pos + 8
-
-            elif self.raw[pos:pos + 4] == b'\xF4\xFF\xFF\xFF': # Display furinaga
-                byte_count = unpack('<H', self.raw[pos + 10:pos + 12])[0]
-                #strings.append(self.raw[pos + 12:pos + 10 + byte_count])
-                pos = pos + 12 + byte_count
-
-            elif self.raw[pos:pos + 4] == b'\xF5\xFF\xFF\xFF': # Choice
-                choice_count = unpack('<I', self.raw[pos + 12:pos + 16])[0]
-                pos += 16 + 4 * choice_count
-                strings.append(' (' if len(strings) > 0 else '(')
-                for choice_index in range(choice_count):
-                    byte_count = unpack('<H', self.raw[pos + 4:pos + 6])[0]
-                    choice_end_pos = pos + 8
-                    while choice_end_pos < pos + 8 + byte_count and \
-                        self.raw[choice_end_pos:choice_end_pos + 2] != b'\0\0':
-                        choice_end_pos += 2
-                    strings.append(self.raw[pos + 8:choice_end_pos].decode('utf-16le'))
-                    if choice_index != choice_count - 1:
-                        strings.append(' / ')
-                    pos = pos + 8 + byte_count
-                strings.append(')')
-
-            elif self.raw[pos:pos + 4] == b'\xF6\xFF\xFF\xFF': # Variables
-                unpacked = unpack('<II', self.raw[pos + 4:pos + 12])
-                strings.append('({}, {})'.format(*unpacked))
-                pos += 12
-
-            elif self.raw[pos:pos + 4] == b'\xF7\xFF\xFF\xFF': # Text color
-                pos += 12
-
-            elif self.raw[pos:pos + 4] == b'\xF9\xFF\xFF\xFF': # Buttons
-                button = unpack('<I', self.raw[pos + 8:pos + 12])[0]
-                if button in SCR.buttons:
-                    strings.append(SCR.buttons[button])
-                else:
-                    strings.append('?')
-                pos += 12
-
-            elif self.raw[pos:pos + 4] == b'\xF0\xFF\xFF\xFF': # Line break
-                strings.append('\\n')
-                pos += 8
-
-            elif self.raw[pos:pos + 4] == b'\xF1\xFF\xFF\xFF':
-                pos += 8
-
-            elif self.raw[pos:pos + 2] == b'\xFF\xFF':
-                pos += 2
+            # Decode the whole run of plain text up to the next control code.
+            run_end = _TEXT_RUN.match(raw, pos).end()
+            if run_end != pos:
+                strings.append(_decode(raw[pos:run_end]))
+                pos = run_end
 
-            elif self.raw[pos:pos + 2] != b'\0\0':
-                strings.append(self.raw[pos:pos + 2].decode('utf-16le'))
+            if raw[pos:pos + 2] == b'\xFF\xFF':
                 pos += 2
-
-            else:
+                continue
+            try:
+                handler = _CONTROL_CODES[_U32.unpack_from(raw, pos)[0]]
+            except (KeyError, struct_error): # End of string
                 break
-        return ''.join(strings)
+            pos = handler(raw, pos, strings)
+        return ''.join(strings), pos
+
+    @classmethod
+    def build(cls, rows, Row=None, template=None):
+        """Build a new SCR file from rows. Return an `SCR` object.
+
+        Rows are packed into a preallocated buffer with `Struct.pack_into`. \
+        Strings are encoded with `encodestring` into a deduplicated string \
+        pool after the rows, and string columns are set to their offsets.
+
+        Params:
+        * `rows`: A sequence of row objects, such as a `Table` object. \
+          String columns must hold strings, or offsets into `template`. \
+          Strings at offsets are copied as raw bytes, with their control \
+          codes.
+        * `Row`: Row class. If None, the class of the first row.
+        * `template`: Optional `SCR` object. Its data before the rows is \
+          kept as the header. Otherwise a minimal header is written.
+        """
+        if Row is None:
+            Row = type(rows[0])
+        struct_obj = Row.struct_obj
+        row_length = struct_obj.size
+
+        if template is not None:
+            header = template.raw[:template.table_offset]
+            table_info_offset = _U32.unpack_from(template.raw, 0x14)[0]
+        else:
+            header = SCR.MAGIC + b'\0' * 0x20
+            table_info_offset = 0x18
+        table_offset = len(header)
+        rows_end = table_offset + len(rows) * row_length
+        if table_info_offset + 12 > table_offset: # Table info after rows
+            table_info_offset = rows_end
+            rows_end += 12
+        pool_offset = (rows_end + 3) & ~3
+
+        buffer = bytearray(pool_offset)
+        buffer[:table_offset] = header
+        _U32.pack_into(buffer, 0x14, table_info_offset)
+        _TABLE_INFO.pack_into(buffer, table_info_offset,
+                              len(rows), row_length, table_offset)
+
+        pool = bytearray()
+        string_offsets = {}
+        template_offsets = {}
+
+        def get_offset_hook(string):
+            if not isinstance(string, type('')):
+                try:
+                    return template_offsets[string]
+                except KeyError:
+                    pass
+                if template is None:
+                    raise TypeError('string column holds an offset, but no '
+                                    'template was given')
+                # `getstring` drops control codes, so copy the raw string.
+                end = template._decodestring(string)[1] + 2
+                offset = pool_offset + len(pool)
+                pool.extend(template.raw[string:end])
+                template_offsets[string] = offset
+                return offset
+            try:
+                return string_offsets[string]
+            except KeyError:
+                offset = pool_offset + len(pool)
+                pool.extend(encodestring(string))
+                string_offsets[string] = offset
+                return offset
+
+        pack_row = struct_obj.pack_into
+        offset = table_offset
+        for row in rows:
+            pack_row(buffer, offset, *row.toraw(get_offset_hook))
+            offset += row_length
+        buffer.extend(pool)
+        return cls(bytes(buffer))
 
     def iterrowbytes(self):
         """Yield a memoryview object of raw bytes of a row."""
@@ -227,6 +493,35 @@ class SCR(object):
             offset = self.table_offset + row_index * self.row_length
             yield mv[offset:offset + self.row_length]
 
+    def iterlines(self, struct=None, string_offsets=[]):
+        """Yield the data as tab-delimited lines, one line per row.
+
+        Params:
+        * `struct`: Python struct format string. If None, dump raw bytes.
+        * `string_offsets`: String offsets.
+        """
+        raw = self.raw
+        struct_obj = None if struct is None else Struct(struct)
+        for row_index in range(self.row_count):
+            local_offset = self.table_offset + row_index * self.row_length
+            row = ['0x{:08X}'.format(local_offset), '0x{:04X}'.format(row_index)]
+
+            # Dump the strings
+            for offset in string_offsets:
+                string_offset = _U32.unpack_from(raw, local_offset + offset)[0]
+                row.append(self.getstring(string_offset))
+
+            # Dump all bytes in the row.
+            if struct_obj is None:
+                if self.row_length:
+                    row.append(_hexrow(
+                        raw[local_offset:local_offset + self.row_length]))
+            else:
+                row.extend([format(num) for num in
+                            struct_obj.unpack_from(raw, local_offset)])
+
+            yield '\t'.join(row)
+
     def tolines(self, struct=None, string_offsets=[]):
         """Dump the data into a list of tab-delimited lines.
         
@@ -234,59 +529,348 @@ class SCR(object):
         * `struct`: Python struct format string. If None, dump raw bytes.
         * `string_offsets`: String offsets.
         """
-        table_info_offset = unpack('<I', self.raw[0x14:0x18])[0]
-        row_count, column_count, table_offset = \
-            unpack('<3I', self.raw[table_info_offset:table_info_offset + 12])
+        return list(self.iterlines(struct, string_offsets))
 
-        table = []
-        for row_index in range(row_count):
-            row = []
-            local_offset = table_offset + row_index * column_count
-            row.append('0x{:08X}'.format(local_offset))
-            row.append('0x{:04X}'.format(row_index))
 
-            # Dump the strings
-            for offset_index in range(len(string_offsets)):
-                offset = string_offsets[offset_index]
-                string_offset = unpack('<I',
-                    self.raw[local_offset + offset:local_offset + offset + 4])[0]
-                row.append(self.getstring(string_offset))
+try:
+    b''.hex('\t')
 
-            # Dump all bytes in the row.
-            rowbytes = self.raw[local_offset:local_offset + column_count]
-            if struct is None:
-                try:
-                    row.extend([format(ord(b), '02X') for b in rowbytes])
-                except TypeError:
-                    row.extend([format(b, '02X') for b in rowbytes])
+    def _hexrow(bytes_obj):
+        """Return bytes as tab-delimited uppercase hex digits."""
+        return bytes_obj.hex('\t').upper()
+
+except (AttributeError, TypeError): # Before Python 3.8
+    def _hexrow(bytes_obj):
+        """Return bytes as tab-delimited uppercase hex digits."""
+        digits = hexlify(bytes_obj).decode('ascii').upper()
+        return '\t'.join([digits[i:i + 2] for i in range(0, len(digits), 2)])
+
+
+def writelines(path, lines):
+    """Write lines to a UTF-8 text file at `path`, as they are generated.
+
+    Lines are separated by a line break, without a trailing one.
+    """
+    with io.open(path, mode='w', encoding='utf-8',
+                 buffering=WRITE_BUFFER_SIZE) as file:
+        for line_index, line in enumerate(lines):
+            if line_index:
+                file.write('\n')
+            file.write(line)
+
+
+def _decode(bytes_obj):
+    return _utf_16_le_decode(bytes_obj, 'strict', True)[0]
+
+
+# Run of 2-byte units which are neither a terminator, nor 0xFFFF, nor the
+# start of a control code.
+_TEXT_RUN = re.compile(
+    br'(?:(?!\x00\x00|\xFF\xFF|[\xE9\xF0\xF1\xF4-\xF7\xF9]\xFF\xFF\xFF)..)*',
+    re.DOTALL)
+# Run of 2-byte units up to a terminator.
+_NONZERO_RUN = re.compile(br'(?:(?!\x00\x00)..)*', re.DOTALL)
+_U16 = Struct('<H')
+_U32 = Struct('<I')
+_TABLE_INFO = Struct('<3I')
+
+
+def _branch(raw, pos, strings):
+    byte_count = _U16.unpack_from(raw, pos + 22)[0]
+    pos += 24
+    strings.append(_decode(raw[pos:pos + byte_count - 2]))
+    strings.append(' / ')
+
+    pos += byte_count
+    if raw[pos:pos + 2] == b'\xFF\xFF':
+        pos += 2
+    byte_count = _U16.unpack_from(raw, pos + 2)[0]
+    strings.append(_decode(raw[pos + 4:pos + 2 + byte_count]))
+    return pos + 4 + byte_count
+
+
+def _pause(raw, pos, strings): # Pause, press A to continue
+    strings.append('\\n')
+    return pos + 8
+
+
+def _furigana(raw, pos, strings): # Display furigana
+    byte_count = _U16.unpack_from(raw, pos + 10)[0]
+    return pos + 12 + byte_count
+
+
+def _choice(raw, pos, strings):
+    choice_count = _U32.unpack_from(raw, pos + 12)[0]
+    pos += 16 + 4 * choice_count
+    strings.append(' (' if len(strings) > 0 else '(')
+    for choice_index in range(choice_count):
+        byte_count = _U16.unpack_from(raw, pos + 4)[0]
+        choice_end_pos = _NONZERO_RUN.match(
+            raw, pos + 8, pos + 8 + byte_count + (byte_count & 1)).end()
+        strings.append(_decode(raw[pos + 8:choice_end_pos]))
+        if choice_index != choice_count - 1:
+            strings.append(' / ')
+        pos = pos + 8 + byte_count
+    strings.append(')')
+    return pos
+
+
+def _variables(raw, pos, strings):
+    strings.append('({}, {})'.format(*unpack_from('<II', raw, pos + 4)))
+    return pos + 12
+
+
+def _text_color(raw, pos, strings):
+    return pos + 12
+
+
+def _button(raw, pos, strings):
+    button = _U32.unpack_from(raw, pos + 8)[0]
+    strings.append(SCR.buttons.get(button, '?'))
+    return pos + 12
+
+
+def _line_break(raw, pos, strings):
+    strings.append('\\n')
+    return pos + 8
+
+
+# Control code handlers, keyed on opcode. Each handler appends the text of
+# the control code to `strings`, and returns the position after it.
+_CONTROL_CODES = {
+    0xFFFFFFE9: _branch,
+    0xFFFFFFF0: _line_break,
+    0xFFFFFFF1: _pause,
+    0xFFFFFFF4: _furigana,
+    0xFFFFFFF5: _choice,
+    0xFFFFFFF6: _variables,
+    0xFFFFFFF7: _text_color,
+    0xFFFFFFF9: _button,
+}
+
+
+def _getstring_reference(self, offset):
+    """Original implementation of `SCR.getstring`, used by `test_getstring`."""
+    pos = offset
+    strings = []
+    while True:
+        if self.raw[pos:pos + 4] == b'\xE9\xFF\xFF\xFF': # Branch
+            byte_count = unpack('<H', self.raw[pos + 22:pos + 24])[0]
+            pos += 24
+            strings.append(self.raw[pos:pos + byte_count - 2]
+                .decode('utf-16le'))
+            strings.append(' / ')
+
+            pos += byte_count
+            if self.raw[pos:pos + 2] == b'\xFF\xFF':
+                pos += 2
+            byte_count = unpack('<H', self.raw[pos + 2:pos + 4])[0]
+            strings.append(self.raw[pos + 4:pos + 2 + byte_count]
+                .decode('utf-16le'))
+            pos = pos + 4 + byte_count
+
+        elif self.raw[pos:pos + 4] == b'\xF1\xFF\xFF\xFF':
+            # Pause, press A to continue
+            strings.append('\\n')
+            pos = pos + 8
+
+        elif self.raw[pos:pos + 4] == b'\xF4\xFF\xFF\xFF': # Display furinaga
+            byte_count = unpack('<H', self.raw[pos + 10:pos + 12])[0]
+            #strings.append(self.raw[pos + 12:pos + 10 + byte_count])
+            pos = pos + 12 + byte_count
+
+        elif self.raw[pos:pos + 4] == b'\xF5\xFF\xFF\xFF': # Choice
+            choice_count = unpack('<I', self.raw[pos + 12:pos + 16])[0]
+            pos += 16 + 4 * choice_count
+            strings.append(' (' if len(strings) > 0 else '(')
+            for choice_index in range(choice_count):
+                byte_count = unpack('<H', self.raw[pos + 4:pos + 6])[0]
+                choice_end_pos = pos + 8
+                while choice_end_pos < pos + 8 + byte_count and \
+                    self.raw[choice_end_pos:choice_end_pos + 2] != b'\0\0':
+                    choice_end_pos += 2
+                strings.append(self.raw[pos + 8:choice_end_pos].decode('utf-16le'))
+                if choice_index != choice_count - 1:
+                    strings.append(' / ')
+                pos = pos + 8 + byte_count
+            strings.append(')')
+
+        elif self.raw[pos:pos + 4] == b'\xF6\xFF\xFF\xFF': # Variables
+            unpacked = unpack('<II', self.raw[pos + 4:pos + 12])
+            strings.append('({}, {})'.format(*unpacked))
+            pos += 12
+
+        elif self.raw[pos:pos + 4] == b'\xF7\xFF\xFF\xFF': # Text color
+            pos += 12
+
+        elif self.raw[pos:pos + 4] == b'\xF9\xFF\xFF\xFF': # Buttons
+            button = unpack('<I', self.raw[pos + 8:pos + 12])[0]
+            if button in SCR.buttons:
+                strings.append(SCR.buttons[button])
             else:
-                unpacked = unpack(struct, rowbytes)
-                for num in unpacked:
-                    row.append(format(num))
+                strings.append('?')
+            pos += 12
 
-            table.append('\t'.join(row))
+        elif self.raw[pos:pos + 4] == b'\xF0\xFF\xFF\xFF': # Line break
+            strings.append('\\n')
+            pos += 8
 
-        return table
+        elif self.raw[pos:pos + 4] == b'\xF1\xFF\xFF\xFF':
+            pos += 8
+
+        elif self.raw[pos:pos + 2] == b'\xFF\xFF':
+            pos += 2
+
+        elif self.raw[pos:pos + 2] != b'\0\0':
+            strings.append(self.raw[pos:pos + 2].decode('utf-16le'))
+            pos += 2
+
+        else:
+            break
+    return ''.join(strings)
+
+
+def encodestring(string):
+    """Encode a string as stored in SCR files, with its terminator.
+
+    This is the inverse of `SCR.getstring` for plain text: '\\n' becomes a \
+    line break code. Other control codes are not produced.
+
+    Raise `ValueError` if `string` contains U+0000 or U+FFFF, which cannot \
+    be stored.
+    """
+    if '\0' in string or '\uffff' in string:
+        raise ValueError('string contains U+0000 or U+FFFF: {!r}'
+                         .format(string))
+    return _LINE_BREAK.join(
+        [line.encode('utf-16le') for line in string.split('\\n')]) + b'\0\0'
+
+
+_LINE_BREAK = b'\xF0\xFF\xFF\xFF\0\0\0\0'
+
+
+def scroffset(header):
+    """Return the offset of SCR data in a file starting with `header`.
+
+    SCR data starts either at 0, or after a 0x10-byte header. Return None if \
+    `header` (at least 0x14 bytes to check both) is not an SCR file.
+    """
+    for offset in (0, 0x10):
+        if header[offset:offset + 4] == SCR.MAGIC:
+            return offset
+    return None
 
 
 def load(path):
     """Load a file."""
-    with open(path, 'rb') as scrfile:
-        magic = scrfile.read(4)
-        if magic == b'\x13\x80\x03\x1D':
-            scrfile.seek(0)
-            raw = scrfile.read()
-        else:
-            scrfile.seek(0x10)
-            magic = scrfile.read(4)
-            if magic == b'\x13\x80\x03\x1D':
-                scrfile.seek(0x10)
-                raw = scrfile.read()
-            else:
-                raise UnsupportedSCRError('unsupported file.')
+    with instrument.stage('scr.read') as stage, open(path, 'rb') as scrfile:
+        offset = scroffset(scrfile.read(0x14))
+        if offset is None:
+            raise UnsupportedSCRError('unsupported file.')
+        scrfile.seek(offset)
+        raw = scrfile.read()
+        stage.add(bytes=len(raw))
     return SCR(raw)
 
 
+def test_getstring():
+    """Compare `SCR.getstring` with the original implementation."""
+    import random
+    from timeit import default_timer
+    from .bench import make_string
+    rng = random.Random(0)
+    raw = bytearray(pack('<20xI12x', 0x18))
+    offsets = []
+    for _ in range(2000):
+        offsets.append(len(raw))
+        raw += make_string(rng, 'all')
+    scr = SCR(bytes(raw))
+
+    for offset in offsets:
+        expected = _getstring_reference(scr, offset)
+        actual = scr.getstring(offset)
+        if actual != expected:
+            raise AssertionError('0x{:X}: {!r} != {!r}'.format(
+                offset, actual, expected))
+
+    scr.cache_size = 0
+    for function in (_getstring_reference, SCR.getstring):
+        start = default_timer()
+        for offset in offsets:
+            function(scr, offset)
+        print('{}: {:.0f} strings/s'.format(
+            function.__name__, len(offsets) / (default_timer() - start)))
+
+
+def test_build():
+    """Check that `SCR.build` round-trips through `load`, and time it."""
+    import random
+    import tempfile
+    from timeit import default_timer
+    from .table import SAMPLE_TABLEINFO
+    Row = newrowclass(SAMPLE_TABLEINFO)
+    rng = random.Random(0)
+    strings = ['Sword', 'Wooden Shield', 'Line 1\\nLine 2', '',
+               '\u3088\u3046\u3053\u305d', 'Trailing \\n']
+    table = Table()
+    for i in range(50000):
+        a, b, c = rng.randint(0, 7), rng.randint(0, 31), rng.randint(0, 15)
+        table.append(Row(id=i & 0xFFFF, c2=b'\x01\x02', name=rng.choice(strings),
+            flags=0x0F00 | a | b << 3 | c << 12, a=a, b=b, c=c,
+            kind=rng.choice(['Weapon', 'Armor', 'Tool']), c11=b'\0',
+            price=rng.randint(-100, 100000), stat=0.5, c20=b'\xAA' * 4))
+
+    start = default_timer()
+    scr = SCR.build(table)
+    elapsed = default_timer() - start
+    print('build: {:.0f} rows/s, {} bytes'.format(len(table) / elapsed,
+                                                  len(scr.raw)))
+
+    def check(scr, expected):
+        with tempfile.NamedTemporaryFile(delete=False) as file:
+            file.write(scr.raw)
+        try:
+            loaded = load(file.name)
+        finally:
+            os.remove(file.name)
+        rows = [Row.feed(bytes_obj, get_string_hook=loaded.getstring)
+                for bytes_obj in loaded.iterrowbytes()]
+        if rows != expected:
+            raise AssertionError('rows differ after round trip')
+
+    check(scr, table)
+
+    # Bit columns are packed without touching the bits around them.
+    first = table[0]._replace(flags=0x0F00, a=5, b=17, c=9)
+    if Row.feed(next(SCR.build([first]).iterrowbytes())).flags != 0x9F8D:
+        raise AssertionError('bit columns are not packed correctly')
+
+    # Rebuild from a template, with a translated string and offsets kept
+    # from the template.
+    offsets = [Row.feed(bytes_obj) for bytes_obj in scr.iterrowbytes()]
+    offsets[1] = offsets[1]._replace(name='Translated')
+    rebuilt = SCR.build(offsets, template=scr)
+    expected = Table(table)
+    expected[1] = expected[1]._replace(name='Translated')
+    check(rebuilt, expected)
+
+    # Strings kept from a template keep their control codes byte for byte.
+    from .bench import make_scr
+    template = SCR(make_scr(200, 50, 'dialogue'))
+    rows = [Row.feed(bytes_obj) for bytes_obj in template.iterrowbytes()]
+    rebuilt = SCR.build(rows, template=template)
+
+    def rawstring(scr, offset):
+        return scr.raw[offset:scr._decodestring(offset)[1] + 2]
+
+    for row, newrow in zip(rows, (Row.feed(bytes_obj)
+                                  for bytes_obj in rebuilt.iterrowbytes())):
+        if rawstring(template, row.name) != rawstring(rebuilt, newrow.name):
+            raise AssertionError('template string 0x{:X} differs after '
+                                 'rebuild'.format(row.name))
+    print('OK')
+
+
 def test_load():
     tm = TableManager()
     table = tm.loadtable('items', 'uk')
@@ -294,6 +878,23 @@ def test_load():
 
 
 if __name__ == '__main__':
+    if len(sys.argv) > 1 and sys.argv[1] == 'export-sqlite':
+        from .export import main
+        sys.exit(main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'pipeline':
+        from .pipeline import main
+        sys.exit(main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'diff':
+        from .diff import main
+        sys.exit(main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'search':
+        from .search import main
+        sys.exit(main(sys.argv[2:]))
+    if len(sys.argv) > 1 and sys.argv[1] == 'daemon':
+        from .daemon import main
+        sys.exit(main(sys.argv[2:]))
+
+    import argparse
     parser = argparse.ArgumentParser()
     parser.add_argument('-f', '--file', help='path to input file')
     parser.add_argument('--str', nargs='*', help='string offsets (relative)')
@@ -302,7 +903,9 @@ if __name__ == '__main__':
         nargs=3, help='add multiple tables to tables.json')
     if DEBUG:
         parser.add_argument('-t', '--test', help='run tests')
+    instrument.add_argument(parser)
     args = parser.parse_args()
+    instrument.setup(args)
 
     if DEBUG and args.test:
         name = 'test_' + args.test
@@ -320,7 +923,8 @@ if __name__ == '__main__':
         if args.str is not None:
             string_offsets = [int(x) for x in args.str]
         outpath = os.path.splitext(os.path.basename(args.file))[0] + '_table.txt'
-        with io.open(outpath, mode='w', encoding='utf-8') as file:
-            file.write('\n'.join(
-                scr.tolines(string_offsets=string_offsets, struct=args.struct)
-            ))
+        with instrument.stage('scr.dump') as stage:
+            writelines(outpath, scr.iterlines(string_offsets=string_offsets,
+                                              struct=args.struct))
+            stage.add(rows=scr.row_count)
+    instrument.report()
@@ -0,0 +1,355 @@
+#!/usr/bin/env python
+"""Full-text search in all strings of the SCR files of a dump.
+
+Strings are decoded once, and their tokens are stored in an SQLite index. \
+Words are matched by prefix. Japanese and Chinese text is indexed as \
+overlapping pairs of characters, so any part of a sentence can be found.
+"""
+
+from __future__ import division, print_function, unicode_literals
+import argparse
+import os
+import re
+import sys
+import unicodedata
+from struct import Struct, error as struct_error
+
+from . import instrument
+from .catalog import SCR as SCR_KIND, open_catalog
+from .scr import load
+try:
+    _unichr = unichr
+except NameError: # Python 3
+    _unichr = chr
+
+
+_CJK = '\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uf900-\ufaff'
+_TOKEN = re.compile('([{0}]+)|([^\\W{0}]+)'.format(_CJK), re.UNICODE)
+
+
+def normalize(text):
+    """Return `text` in the form which is indexed: NFKC, lowercase."""
+    return unicodedata.normalize('NFKC', text).lower()
+
+
+def tokenize(text):
+    """Return the set of tokens of normalized `text`.
+
+    Words are tokens. Runs of Japanese or Chinese characters are split in \
+    overlapping pairs of characters, and their last character is a token \
+    too, so that every character starts a token.
+    """
+    tokens = set()
+    for cjk, word in _TOKEN.findall(text):
+        if word:
+            tokens.add(word)
+        else:
+            tokens.update(cjk[i:i + 2] for i in range(len(cjk) - 1))
+            tokens.add(cjk[-1])
+    return tokens
+
+
+def _readstrings(scr):
+    """Return (offset, row index, string) of all strings of an `SCR` object.
+
+    Strings are decoded once, from the string region. Offsets which rows \
+    hold in a 4-byte aligned column are decoded too, if the sequential \
+    decoding of the region missed them. The row index is the first row \
+    which holds the offset of the string, or None. Empty strings are \
+    skipped.
+    """
+    scr.predecode()
+    pool = dict(scr.string_pool)
+    start = scr.table_offset + scr.row_count * scr.row_length
+    end = len(scr.raw)
+    rows = {}
+    words = Struct('<{}I'.format(scr.row_length // 4))
+    for row_index, bytes_obj in enumerate(scr.iterrowbytes()):
+        for value in words.unpack_from(bytes_obj):
+            if value in rows:
+                continue
+            # Strings are UTF-16, at an even distance from the region start.
+            if value not in pool:
+                if not start <= value < end or (value - start) & 1:
+                    continue
+                try:
+                    pool[value] = scr._decodestring(value)[0]
+                except (UnicodeDecodeError, struct_error):
+                    continue
+            rows[value] = row_index
+    return [(offset, rows.get(offset), string)
+            for offset, string in sorted(pool.items()) if string]
+
+
+def _indexfile(path):
+    """Read the strings of an SCR file, with their tokens.
+
+    Return a list of (offset, row index, string, tokens), or None if the \
+    file cannot be read.
+    """
+    with instrument.stage('search.decode') as stage:
+        try:
+            strings = _readstrings(load(path))
+        except Exception: # A broken file must not stop the update.
+            return None
+        stage.add(strings=len(strings))
+    return [(offset, row_index, string, tokenize(normalize(string)))
+            for offset, row_index, string in strings]
+
+
+def _pooled_indexfile(path):
+    """Run `_indexfile` in a worker process, and add its statistics."""
+    return _indexfile(path), instrument.collect()
+
+
+class StringIndex(object):
+    """Persistent SQLite index of the strings of all SCR files in a folder.
+
+    Each file is a shard of the index: its strings and tokens are replaced \
+    when the file changes, and the other files are left alone.
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS files (
+            id INTEGER PRIMARY KEY,
+            path TEXT UNIQUE NOT NULL,
+            size INTEGER NOT NULL,
+            mtime REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS strings (
+            id INTEGER PRIMARY KEY,
+            file_id INTEGER NOT NULL,
+            offset INTEGER NOT NULL,
+            row INTEGER,
+            text TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS tokens (
+            token TEXT NOT NULL,
+            string_id INTEGER NOT NULL,
+            file_id INTEGER NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS strings_file_id ON strings (file_id);
+        CREATE INDEX IF NOT EXISTS tokens_token ON tokens (token);
+        CREATE INDEX IF NOT EXISTS tokens_file_id ON tokens (file_id);
+    """
+
+    def __init__(self, path):
+        """Open or create the index at `path`.
+
+        File paths are stored relative to the folder containing the index.
+        """
+        import sqlite3
+        self.path = path
+        self.root = os.path.dirname(os.path.abspath(path))
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(StringIndex.SCHEMA)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @staticmethod
+    def default_path(folder):
+        """Return the default index path of `folder`."""
+        return os.path.normpath(folder) + '_strings.sqlite'
+
+    def update(self, folder, jobs=1, progress=None):
+        """Index all SCR files in `folder`.
+
+        Only files whose size or modification time changed since the last \
+        update are decoded again, in `jobs` worker processes. Files which no \
+        longer exist are removed. Files which cannot be read are not \
+        recorded, so they are read again by the next update. `progress` is \
+        an optional callable, called with (done file count, total file count).
+
+        Return the number of indexed files.
+        """
+        cursor = self.connection.cursor()
+        known = {}
+        for file_id, relpath, size, mtime in \
+                cursor.execute('SELECT id, path, size, mtime FROM files'):
+            known[relpath] = (file_id, size, mtime)
+
+        catalog = open_catalog(folder)
+        stale = []
+        current = set()
+        for relpath, (kind, _, size, mtime) in catalog.entries.items():
+            if kind != SCR_KIND:
+                continue
+            path = os.path.join(folder, relpath.replace('/', os.sep))
+            relpath = os.path.relpath(path, self.root).replace(os.sep, '/')
+            current.add(relpath)
+            if relpath in known:
+                file_id, oldsize, oldmtime = known[relpath]
+                if oldsize == size and oldmtime == mtime:
+                    continue
+                self._remove(cursor, file_id)
+            stale.append((relpath, path, size, mtime))
+        for relpath, (file_id, _, _) in known.items():
+            if relpath not in current:
+                self._remove(cursor, file_id)
+
+        pool = None
+        if jobs > 1 and len(stale) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(jobs, instrument.reset)
+            results = pool.imap(_pooled_indexfile,
+                                [item[1] for item in stale])
+        else:
+            results = ((_indexfile(item[1]), None) for item in stale)
+        indexed_count = 0
+        try:
+            for done, ((relpath, path, size, mtime), (strings, stats)) in \
+                    enumerate(zip(stale, results), 1):
+                instrument.merge(stats)
+                if strings is not None:
+                    self._insert(cursor, relpath, size, mtime, strings)
+                    indexed_count += 1
+                if progress is not None:
+                    progress(done, len(stale))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        self.connection.commit()
+        return indexed_count
+
+    @staticmethod
+    def _insert(cursor, relpath, size, mtime, strings):
+        cursor.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                       (relpath, size, mtime))
+        file_id = cursor.lastrowid
+        for offset, row_index, string, tokens in strings:
+            cursor.execute('INSERT INTO strings (file_id, offset, row, text) '
+                           'VALUES (?, ?, ?, ?)',
+                           (file_id, offset, row_index, string))
+            string_id = cursor.lastrowid
+            cursor.executemany('INSERT INTO tokens VALUES (?, ?, ?)',
+                               ((token, string_id, file_id)
+                                for token in tokens))
+
+    @staticmethod
+    def _remove(cursor, file_id):
+        cursor.execute('DELETE FROM tokens WHERE file_id = ?', (file_id,))
+        cursor.execute('DELETE FROM strings WHERE file_id = ?', (file_id,))
+        cursor.execute('DELETE FROM files WHERE id = ?', (file_id,))
+
+    def _lookup(self, token, prefix):
+        """Return the set of string IDs with `token`, or a token starting \
+        with it if `prefix` is True.
+        """
+        if prefix:
+            end = token[:-1] + _unichr(ord(token[-1]) + 1)
+            rows = self.connection.execute(
+                'SELECT string_id FROM tokens WHERE token >= ? AND token < ?',
+                (token, end))
+        else:
+            rows = self.connection.execute(
+                'SELECT string_id FROM tokens WHERE token = ?', (token,))
+        return set(row[0] for row in rows)
+
+    def search(self, query, limit=100):
+        """Find strings containing `query`.
+
+        All words of `query` must start a word of the string, and all of its \
+        Japanese or Chinese text must be in the string. The search is case \
+        insensitive, and full-width and half-width forms match.
+
+        Return a list of up to `limit` tuples of (file path, string offset, \
+        row index or None, string), ordered by file and offset.
+        """
+        query = normalize(query)
+        terms = []
+        cjkruns = []
+        for cjk, word in _TOKEN.findall(query):
+            if word:
+                terms.append((word, True))
+            elif len(cjk) == 1:
+                terms.append((cjk, True))
+            else:
+                cjkruns.append(cjk)
+                terms.extend((cjk[i:i + 2], False)
+                             for i in range(len(cjk) - 1))
+        if not terms:
+            return []
+
+        ids = None
+        for token, prefix in sorted(set(terms), key=lambda term: term[1]):
+            found = self._lookup(token, prefix)
+            ids = found if ids is None else ids & found
+            if not ids:
+                return []
+
+        # Without text to check, the database can stop at `limit`.
+        sql = ('SELECT files.path, offset, row, text FROM strings '
+               'JOIN files ON files.id = strings.file_id '
+               'WHERE strings.id IN ({}) ORDER BY files.path, offset'.format(
+                   ','.join(str(string_id) for string_id in ids)))
+        if not cjkruns:
+            sql += ' LIMIT {:d}'.format(limit)
+        results = []
+        for file_path, offset, row_index, text in self.connection.execute(sql):
+            # Pairs of characters may be found apart from each other.
+            if cjkruns:
+                normalized = normalize(text)
+                if not all(run in normalized for run in cjkruns):
+                    continue
+            results.append((os.path.join(self.root, file_path.replace(
+                '/', os.sep)), offset, row_index, text))
+            if len(results) >= limit:
+                break
+        return results
+
+
+def _printprogress(done, total):
+    sys.stderr.write('\r[{}/{}] files indexed'.format(done, total))
+    if done == total:
+        sys.stderr.write('\n')
+    sys.stderr.flush()
+
+
+def main(argv=None):
+    """Entry point of the `search` command."""
+    parser = argparse.ArgumentParser(prog='scr.py search',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('query', help='text to search')
+    parser.add_argument('-d', '--dump', default='bin',
+                        help='folder which contains SCR files')
+    parser.add_argument('-i', '--index', default=None,
+                        help='index path (default: <dump>_strings.sqlite)')
+    parser.add_argument('-n', '--limit', type=int, default=100,
+                        help='maximum number of results')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of worker processes updating the index')
+    parser.add_argument('--no-update', action='store_true',
+                        help='do not refresh the index before searching')
+    instrument.add_argument(parser)
+    args = parser.parse_args(argv)
+    instrument.setup(args)
+
+    query = args.query
+    if isinstance(query, bytes): # Python 2
+        try:
+            query = query.decode(sys.getfilesystemencoding() or 'utf-8')
+        except UnicodeDecodeError: # e.g. an ASCII locale
+            query = query.decode('utf-8')
+    indexpath = args.index or StringIndex.default_path(args.dump)
+    with StringIndex(indexpath) as index:
+        if not args.no_update:
+            index.update(args.dump, args.jobs, _printprogress)
+        with instrument.stage('search.query'):
+            results = index.search(query, args.limit)
+    for path, offset, row_index, text in results:
+        print('{}\t0x{:X}\t{}\t{}'.format(
+            path, offset, '' if row_index is None else row_index,
+            text.replace('\n', '\\n')))
+    instrument.report()
+    return 0 if results else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
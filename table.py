@@ -1,6 +1,10 @@
 #!/usr/bin/env python
 
 from __future__ import division, print_function, unicode_literals
+import re
+from array import array
+from binascii import hexlify
+from bisect import bisect_left, bisect_right
 from collections import OrderedDict, namedtuple
 from struct import Struct, calcsize
 
@@ -9,28 +13,170 @@ from struct import Struct, calcsize
 # TABLE STUFF
 ###############################################################################   
 class Table(list):
-    """Table class."""
+    """Table class.
+
+    Hash indexes and sorted indexes of columns are built on demand by \
+    `lookup`, `where` and `join`, and dropped whenever the table changes.
+    """
+
+    def __init__(self, *args):
+        list.__init__(self, *args)
+        self._hashindexes = {}
+        self._sortedindexes = {}
+
+    def __reduce__(self):
+        # Rows only: indexes are rebuilt on demand, and unpickling a list
+        # subclass extends it before its attributes are restored.
+        return self.__class__, (list(self),)
+
+    def _invalidate(self):
+        self._hashindexes.clear()
+        self._sortedindexes.clear()
+
+    def __setitem__(self, index, element):
+        self._invalidate()
+        list.__setitem__(self, index, element)
+
+    def __delitem__(self, index):
+        self._invalidate()
+        list.__delitem__(self, index)
+
+    def __setslice__(self, i, j, iterable): # Python 2
+        self._invalidate()
+        list.__setslice__(self, i, j, iterable)
+
+    def __delslice__(self, i, j): # Python 2
+        self._invalidate()
+        list.__delslice__(self, i, j)
+
+    def __iadd__(self, iterable):
+        self._invalidate()
+        return list.__iadd__(self, iterable)
+
+    def __imul__(self, count):
+        self._invalidate()
+        return list.__imul__(self, count)
+
+    def append(self, element):
+        self._invalidate()
+        list.append(self, element)
+
+    def extend(self, iterable):
+        self._invalidate()
+        list.extend(self, iterable)
+
+    def insert(self, index, element):
+        self._invalidate()
+        list.insert(self, index, element)
+
+    def pop(self, *args):
+        self._invalidate()
+        return list.pop(self, *args)
+
+    def remove(self, element):
+        self._invalidate()
+        list.remove(self, element)
+
+    def clear(self):
+        self._invalidate()
+        del self[:]
+
+    def sort(self, *args, **kwargs):
+        self._invalidate()
+        list.sort(self, *args, **kwargs)
+
+    def reverse(self):
+        self._invalidate()
+        list.reverse(self)
+
+    def _columnindex(self, column):
+        """Return index of `column`, given by name or by index."""
+        if isinstance(column, int):
+            return column
+        return self[0]._fields.index(column)
+
+    def hashindex(self, column):
+        """Return a dict which maps values of `column` to row indices."""
+        column = self._columnindex(column)
+        try:
+            return self._hashindexes[column]
+        except KeyError:
+            pass
+        index = {}
+        for row_index, row in enumerate(self):
+            index.setdefault(row[column], []).append(row_index)
+        self._hashindexes[column] = index
+        return index
+
+    def sortedindex(self, column):
+        """Return a tuple of (sorted values of `column`, row indices)."""
+        column = self._columnindex(column)
+        try:
+            return self._sortedindexes[column]
+        except KeyError:
+            pass
+        row_indices = sorted(range(len(self)), key=lambda i: self[i][column])
+        index = ([self[i][column] for i in row_indices], row_indices)
+        self._sortedindexes[column] = index
+        return index
+
+    def lookup(self, column, value):
+        """Return a list of rows whose `column` equals `value`."""
+        if not self:
+            return []
+        return [self[i] for i in self.hashindex(column).get(value, ())]
+
+    def where(self, column, lo=None, hi=None):
+        """Return a list of rows with `lo` <= `column` <= `hi`, sorted by \
+        `column`. A bound of None is open."""
+        if not self:
+            return []
+        values, row_indices = self.sortedindex(column)
+        start = 0 if lo is None else bisect_left(values, lo)
+        stop = len(values) if hi is None else bisect_right(values, hi)
+        return [self[i] for i in row_indices[start:stop]]
+
+    def join(self, other, column, othercolumn=None):
+        """Yield (row, other row) pairs whose `column` of this table equals \
+        `othercolumn` of `other`, like an SQL inner join.
+
+        Params:
+        * `other`: Another `Table` object.
+        * `column`: Column of this table.
+        * `othercolumn`: Column of `other`. Same as `column` if None.
+        """
+        if not self or not other:
+            return
+        # Column names are resolved in each table, whose layouts may differ.
+        index = other.hashindex(column if othercolumn is None else othercolumn)
+        column = self._columnindex(column)
+        for row in self:
+            for row_index in index.get(row[column], ()):
+                yield row, other[row_index]
+
     def itercolumn(self, index):
         """Get column iterator."""
         for row in self:
             yield row[index]
 
+    def itertext(self):
+        """Yield rows in tab-delimited text format, one line per row."""
+        for row in self:
+            yield row.totext()
+
     def totext(self):
         """Returns table in tab-delimited text format."""
-        return '\n'.join([row.totext() for row in self])
+        return '\n'.join(self.itertext())
 
 
-class TypedTable(list):
+class TypedTable(Table):
     """Table with simple type checking. Not recommended."""
 
     def __init__(self, iterable=None):
         self.rowclass = None
+        Table.__init__(self)
         if iterable:
-            for element in iterable:
-                self.__check(element)
-            list.__init__(iterable)
-        else:
-            list.__init__()
+            self.extend(iterable)
 
     def __check(self, element):
         if self.rowclass is None:
@@ -41,21 +187,554 @@ class TypedTable(list):
                 .format(self.rowclass.__name__, element.__class__.__name__))
 
     def __setitem__(self, index, element):
-        self.__check(element)
-        list.__setitem__(self, index, element)
+        if isinstance(index, slice):
+            element = list(element)
+            for item in element:
+                self.__check(item)
+        else:
+            self.__check(element)
+        Table.__setitem__(self, index, element)
+
+    def __iadd__(self, iterable):
+        self.extend(iterable)
+        return self
 
     def append(self, element):
         self.__check(element)
-        list.append(self, element)
+        Table.append(self, element)
 
     def extend(self, iterable):
-        for element in iterable:
+        elements = list(iterable)
+        for element in elements:
             self.__check(element)
-        list.extend(self, element)
+        Table.extend(self, elements)
 
     def insert(self, index, element):
         self.__check(element)
-        list.insert(self, element)
+        Table.insert(self, index, element)
+
+
+class MultiLangTable(object):
+    """One table in several languages, with non-string columns stored once.
+
+    Language variants of a table only differ in their string columns, so \
+    each row keeps one tuple of shared values, and each language keeps one \
+    list per string column.
+    """
+
+    def __init__(self, Row):
+        self.Row = Row
+        specs = _fieldspecs(Row)
+        self.stringfields = [field for field, spec in enumerate(specs)
+                             if spec[0] == 'str']
+        self.sharedfields = [field for field, spec in enumerate(specs)
+                             if spec[0] != 'str']
+        self.shared = []
+        self.strings = OrderedDict()
+
+    def __len__(self):
+        return len(self.shared)
+
+    @property
+    def languages(self):
+        """List of languages."""
+        return list(self.strings)
+
+    def _shared(self, row):
+        return tuple([row[field] for field in self.sharedfields])
+
+    def add(self, language, rows):
+        """Add rows of a language, in a single pass.
+
+        Raise `ValueError` if non-string data of `rows` does not match rows \
+        of the languages already added.
+        """
+        columns = [[] for _ in self.stringfields]
+        appends = [column.append for column in columns]
+        stringfields = list(zip(self.stringfields, appends))
+        first = not self.strings
+        shared = self.shared
+        row_index = -1
+        for row_index, row in enumerate(rows):
+            values = self._shared(row)
+            if first:
+                shared.append(values)
+            elif row_index >= len(shared) or shared[row_index] != values:
+                raise ValueError('row {} of {!r} does not match {!r}'.format(
+                    row_index, language, self.languages[0]))
+            for field, append in stringfields:
+                append(row[field])
+        if row_index + 1 != len(shared):
+            raise ValueError('{!r} has {} rows, {!r} has {}'.format(
+                language, row_index + 1, self.languages[0], len(shared)))
+        self.strings[language] = columns
+
+    def getrow(self, index, language):
+        """Return the `Row` object at `index` in `language`."""
+        values = [None] * len(self.Row._fields)
+        for field, value in zip(self.sharedfields, self.shared[index]):
+            values[field] = value
+        for field, column in zip(self.stringfields, self.strings[language]):
+            values[field] = column[index]
+        return tuple.__new__(self.Row, values)
+
+    def table(self, language):
+        """Return a `Table` object of `language`."""
+        return Table(self.getrow(index, language)
+                     for index in range(len(self.shared)))
+
+    __getitem__ = table
+
+    def column(self, column, language=None):
+        """Return a column, by name or by index, as a list.
+
+        `language` is only needed for string columns.
+        """
+        if not isinstance(column, int):
+            column = self.Row._fields.index(column)
+        if column in self.stringfields:
+            return self.strings[language][self.stringfields.index(column)]
+        position = self.sharedfields.index(column)
+        return [values[position] for values in self.shared]
+
+    def compare(self, column, language, otherlanguage):
+        """Yield (row index, string, other string) for each row whose \
+        string `column` differs between two languages."""
+        strings = self.column(column, language)
+        otherstrings = self.column(column, otherlanguage)
+        for index, (string, otherstring) in \
+                enumerate(zip(strings, otherstrings)):
+            if string != otherstring:
+                yield index, string, otherstring
+
+
+class RowProxy(object):
+    """Row of a `LazyTable`. Fields are decoded when accessed."""
+    __slots__ = ('table', 'index', 'bytes_obj', 'values')
+
+    def __init__(self, table, index, bytes_obj):
+        self.table = table
+        self.index = index
+        self.bytes_obj = bytes_obj
+        self.values = {} if table.memoize else None
+
+    def __getattr__(self, name):
+        try:
+            field = self.table.fieldindices[name]
+        except KeyError:
+            raise AttributeError(name)
+        return self[field]
+
+    def __getitem__(self, field):
+        if isinstance(field, slice):
+            return tuple(self[i] for i in range(*field.indices(len(self))))
+        if field < 0:
+            field += len(self)
+        if self.values is None:
+            return self.table.decodefield(self.bytes_obj, field)
+        try:
+            return self.values[field]
+        except KeyError:
+            value = self.table.decodefield(self.bytes_obj, field)
+            self.values[field] = value
+            return value
+
+    def __len__(self):
+        return len(self.table.Row._fields)
+
+    def __iter__(self):
+        for field in range(len(self)):
+            yield self[field]
+
+    def torow(self):
+        """Decode all fields. Return a `Row` object."""
+        return self.table.Row.feed(self.bytes_obj,
+                                   get_string_hook=self.table.get_string_hook)
+
+    def __repr__(self):
+        return 'RowProxy({}, index={})'.format(
+            self.table.Row.__name__, self.index)
+
+
+class LazyTable(object):
+    """Table whose rows are proxies over the raw row data of an SCR object.
+
+    Nothing is decoded up front: each field is unpacked, and strings are \
+    decoded, only when accessed. With `memoize`, row proxies and decoded \
+    fields are kept, so memory grows with the number of rows used.
+    """
+
+    def __init__(self, scrfile, Row, get_string_hook=None, memoize=False):
+        self.scrfile = scrfile
+        self.Row = Row
+        self.get_string_hook = get_string_hook
+        self.memoize = memoize
+        self.view = memoryview(scrfile.raw)
+        self.fieldspecs = _fieldspecs(Row)
+        self.fieldindices = dict((name, index)
+                                 for index, name in enumerate(Row._fields))
+        self.rawfields = _rawfields(Row)
+        self.proxies = {}
+
+    def __len__(self):
+        return self.scrfile.row_count
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('table index out of range')
+        try:
+            return self.proxies[index]
+        except KeyError:
+            pass
+        offset = self.scrfile.table_offset + index * self.scrfile.row_length
+        proxy = RowProxy(self, index,
+                         self.view[offset:offset + self.scrfile.row_length])
+        if self.memoize:
+            self.proxies[index] = proxy
+        return proxy
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def decodefield(self, bytes_obj, field):
+        """Decode field at index `field` from raw row data."""
+        kind, rawindex, arg = self.fieldspecs[field]
+        struct_obj, offset = self.rawfields[rawindex]
+        value = struct_obj.unpack_from(bytes_obj, offset)[0]
+        if kind == 'str':
+            if self.get_string_hook is not None:
+                return self.get_string_hook(value)
+        elif kind == 'bit':
+            return (value >> arg[0]) & arg[1]
+        elif kind == 'enum':
+            return arg[format(value)]
+        return value
+
+    def itercolumn(self, index):
+        """Get column iterator. Only the column is decoded."""
+        if not isinstance(index, int):
+            index = self.fieldindices[index]
+        for bytes_obj in self.scrfile.iterrowbytes():
+            yield self.decodefield(bytes_obj, index)
+
+
+class StringColumn(object):
+    """String column of an `ArrayTable`, decoded lazily."""
+
+    def __init__(self, offsets, get_string_hook):
+        self.offsets = offsets
+        self.get_string_hook = get_string_hook
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self.get_string_hook(offset)
+                    for offset in self.offsets[index].tolist()]
+        return self.get_string_hook(int(self.offsets[index]))
+
+    def __iter__(self):
+        for offset in self.offsets.tolist():
+            yield self.get_string_hook(offset)
+
+
+class ArrayTable(object):
+    """Table backed by a NumPy structured array over the raw row data.
+
+    Plain columns are views of the structured array. Bit columns and enum \
+    columns are computed with vectorized operations on first access, and \
+    string columns are decoded lazily.
+    """
+
+    def __init__(self, array, Row, get_string_hook=None):
+        self.array = array
+        self.Row = Row
+        self.get_string_hook = get_string_hook
+        self.fieldspecs = _fieldspecs(Row)
+        self.rawnames = [Row._fields[i] for i, spec in
+                         enumerate(self.fieldspecs) if spec[0] != 'bit']
+        self._columns = {}
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getitem__(self, index):
+        """Return row at `index` as a `Row` object."""
+        return self.Row.feed(self.array[index].tobytes(),
+                             get_string_hook=self.get_string_hook)
+
+    def __iter__(self):
+        for index in range(len(self.array)):
+            yield self[index]
+
+    def column(self, column):
+        """Return a column, by name or by index."""
+        if not isinstance(column, int):
+            column = self.Row._fields.index(column)
+        try:
+            return self._columns[column]
+        except KeyError:
+            pass
+
+        import numpy as np
+        kind, rawindex, arg = self.fieldspecs[column]
+        values = self.array[self.rawnames[rawindex]]
+        if kind == 'bit':
+            offset, mask = arg
+            values = (values >> offset) & mask
+        elif kind == 'enum':
+            keys, inverse = np.unique(values, return_inverse=True)
+            names = np.array([arg[format(key)] for key in keys.tolist()],
+                             dtype=object)
+            values = names[inverse]
+        elif kind == 'str' and self.get_string_hook is not None:
+            values = StringColumn(values, self.get_string_hook)
+        self._columns[column] = values
+        return values
+
+    itercolumn = column
+
+
+COLUMNAR_CHUNK_ROWS = 0x1000  # Rows unpacked at once by ColumnarTable
+
+
+class ColumnarTable(object):
+    """Table which stores each column of an SCR object in an `array.array`.
+
+    Numeric and bit columns are typed arrays, enum and string columns keep \
+    raw values and offsets in arrays, and are decoded when read. Gaps are \
+    packed in one bytearray. Rows are rebuilt on demand. Requires only the \
+    standard library.
+    """
+
+    def __init__(self, scrfile, Row, get_string_hook=None,
+                 chunk_rows=COLUMNAR_CHUNK_ROWS):
+        """Params:
+        * `scrfile`: `SCR` object. Its data is not needed after loading, \
+          except to decode strings.
+        * `Row`: Row class created by `newrowclass`.
+        * `get_string_hook`: Function decoding strings, usually \
+          `scrfile.getstring`. If None, string columns are offsets.
+        * `chunk_rows`: Number of rows unpacked at once.
+        """
+        self.Row = Row
+        self.get_string_hook = get_string_hook
+        self.fieldspecs = _fieldspecs(Row)
+        self.row_count = scrfile.row_count
+        self.rawcolumns = _unpackcolumns(scrfile, Row, chunk_rows)
+        self._columns = {}
+
+    def __len__(self):
+        return self.row_count
+
+    def __getitem__(self, index):
+        """Return row at `index` as a `Row` object."""
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('table index out of range')
+        rawdata = [values[index] for values in self.rawcolumns]
+        return self.Row.feed(self.Row.struct_obj.pack(*rawdata),
+                             get_string_hook=self.get_string_hook)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def column(self, column):
+        """Return a column, by name or by index.
+
+        Numeric and bit columns are `array.array` objects. Enum columns are \
+        lists of names, string columns are `StringColumn` objects, and gaps \
+        are lists of bytes.
+        """
+        if not isinstance(column, int):
+            column = self.Row._fields.index(column)
+        try:
+            return self._columns[column]
+        except KeyError:
+            pass
+
+        kind, rawindex, arg = self.fieldspecs[column]
+        values = self.rawcolumns[rawindex]
+        if kind == 'bit':
+            offset, mask = arg
+            values = array(values.typecode, [(value >> offset) & mask
+                                             for value in values])
+        elif kind == 'enum':
+            names = dict((value, arg[format(value)]) for value in set(values))
+            values = [names[value] for value in values]
+        elif kind == 'str' and self.get_string_hook is not None:
+            values = StringColumn(values, self.get_string_hook)
+        elif isinstance(values, _GapColumn):
+            values = list(values)
+        self._columns[column] = values
+        return values
+
+    itercolumn = column
+
+
+class _GapColumn(object):
+    """Gap bytes of all rows, packed in one bytearray."""
+
+    def __init__(self, width):
+        self.width = width
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data) // self.width
+
+    def __getitem__(self, index):
+        start = index * self.width
+        return bytes(self.data[start:start + self.width])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+
+def _arraytypecode(code):
+    """Return the `array` type code of struct type `code`, or None."""
+    if code in 'fd':
+        return code
+    size = calcsize('<' + code)
+    for typecode in ('bhilq' if code.islower() else 'BHILQ'):
+        try:
+            if array(typecode).itemsize == size:
+                return typecode
+        except ValueError: # 'q' and 'Q' before Python 3.3
+            pass
+    return None
+
+
+def _unpackcolumns(scrfile, Row, chunk_rows=COLUMNAR_CHUNK_ROWS):
+    """Unpack all rows of an SCR object into one sequence per raw value.
+
+    Rows are unpacked `chunk_rows` at a time, with one struct call per \
+    chunk.
+    """
+    structstr = Row.struct_obj.format
+    if not isinstance(structstr, str):
+        structstr = structstr.decode('ascii')
+    endianess, body = structstr[0], structstr[1:]
+    columns = []
+    for count, code in re.findall(r'(\d*)(\D)', body):
+        if code == 's':
+            columns.append(_GapColumn(int(count or 1)))
+        else:
+            typecode = _arraytypecode(code)
+            columns.append([] if typecode is None else array(typecode))
+    width = len(columns)
+
+    raw = scrfile.raw
+    row_length = scrfile.row_length
+    struct_obj = None
+    for start in range(0, scrfile.row_count, chunk_rows):
+        count = min(chunk_rows, scrfile.row_count - start)
+        if struct_obj is None or count != chunk_rows:
+            struct_obj = Struct(endianess + body * count)
+        values = struct_obj.unpack_from(
+            raw, scrfile.table_offset + start * row_length)
+        for rawindex, column in enumerate(columns):
+            if isinstance(column, _GapColumn):
+                column.data.extend(b''.join(values[rawindex::width]))
+            else:
+                column.extend(values[rawindex::width])
+    return columns
+
+
+def _fieldspecs(Row):
+    """Return how each field of `Row` is computed from unpacked row data.
+
+    Each item is a tuple of (kind, index in unpacked data, argument):
+    * ('raw', index, None): plain value, or bytes of a gap.
+    * ('str', index, None): string offset.
+    * ('bit', index, (offset, mask)): bit column of a bit field.
+    * ('enum', index, enum map): enum value.
+    """
+    specs = []
+    for rawindex, info in enumerate(Row.columns):
+        if info['type'] == 'str':
+            specs.append(('str', rawindex, None))
+        elif info['type'].startswith('bit'):
+            specs.append(('raw', rawindex, None))
+            for bitcolumn in info['columns']:
+                specs.append(('bit', rawindex, (
+                    bitcolumn['offset'], (1 << bitcolumn['length']) - 1)))
+        elif info['type'].startswith('enum'):
+            specs.append(('enum', rawindex, info['enum']))
+        else:
+            specs.append(('raw', rawindex, None))
+    return specs
+
+
+def _rawfields(Row):
+    """Return a (Struct, offset in row) tuple for each unpacked value."""
+    structstr = Row.struct_obj.format
+    if not isinstance(structstr, str):
+        structstr = structstr.decode('ascii')
+    endianess = structstr[0]
+    fields = []
+    offset = 0
+    for count, code in re.findall(r'(\d*)(\D)', structstr[1:]):
+        struct_obj = Struct(endianess + count + code)
+        fields.append((struct_obj, offset))
+        offset += struct_obj.size
+    return fields
+
+
+def newdtype(tableinfo):
+    """Create a NumPy structured dtype equivalent to the row structure.
+
+    Field names match the row class created by `newrowclass`, without bit \
+    columns. Gaps are void fields.
+    """
+    import numpy as np
+    types = {'s8': 'i1', 'u8': 'u1', 's16': 'i2', 'u16': 'u2', 's32': 'i4',
+        'u32': 'u4', 's64': 'i8', 'u64': 'u8', 'f32': 'f4', 'str': 'u4',
+        'ptr': 'u4', 'bit8': 'u1', 'bit16': 'u2', 'bit32': 'u4', 'bit64': 'u8',
+        'enum8': 'u1', 'enum16': 'u2'}
+    endianess = tableinfo.get('endianess', '<')
+    names = []
+    formats = []
+    offsets = []
+    gapstart = 0
+    for column in tableinfo['columns']:
+        if column['offset'] > gapstart:
+            names.append('c{}'.format(gapstart))
+            formats.append('V{}'.format(column['offset'] - gapstart))
+            offsets.append(gapstart)
+        names.append(column['name'])
+        formats.append(endianess + types[column['type']])
+        offsets.append(column['offset'])
+        gapstart = column['offset'] + int(types[column['type']][1])
+    if gapstart < tableinfo['row_length']:
+        names.append('c{}'.format(gapstart))
+        formats.append('V{}'.format(tableinfo['row_length'] - gapstart))
+        offsets.append(gapstart)
+    return np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+                     'itemsize': tableinfo['row_length']})
+
+
+def loadarray(scrfile, tableinfo, Row=None):
+    """Load all rows of an SCR object into an `ArrayTable`. Requires NumPy.
+
+    The row block is a single view over `scrfile.raw`, without copy.
+    """
+    import numpy as np
+    if Row is None:
+        Row = newrowclass(tableinfo)
+    array = np.frombuffer(scrfile.raw, dtype=newdtype(tableinfo),
+                          count=scrfile.row_count, offset=scrfile.table_offset)
+    return ArrayTable(array, Row, get_string_hook=scrfile.getstring)
 
 
 def feed(cls, bytes_obj, get_string_hook=None):
@@ -87,7 +766,7 @@ def totext(self):
                 words.append(format(self[column_index], bitcolumn['format']))
                 column_index += 1
         elif column['type'] == 'gap':
-            words.append(hexlify(self[column_index]))
+            words.append(hexlify(self[column_index]).decode('ascii'))
             column_index += 1
         else:
             words.append(format(self[column_index], column['format']))
@@ -102,29 +781,31 @@ def tobytes(self):
         if column['type'].startswith('bit'):
             bitdata = self.__getattr__(column['name'])
             for bitcolumn in column['columns']:
-                bitdata |= ((1 << bitcolumn['length']) - 1) << bitcolumn['offset']
-                bitdata &= self.__getattr__(bitcolumn['name']) << bitcolumn['offset']
+                mask = (1 << bitcolumn['length']) - 1
+                bitdata &= ~(mask << bitcolumn['offset'])
+                bitdata |= (self.__getattr__(bitcolumn['name']) & mask) \
+                    << bitcolumn['offset']
             rowdata.append(bitdata)
         else:
             rowdata.append(self.__getattr__(column['name']))
     return self.struct_obj.pack(*rowdata)
 
 
-def newrowclass(tableinfo):
-    """Create a new row class.
+_rowclasses = {}  # Row classes created by newrowclass, keyed by table name
 
-    If no 'endianess' key was found in tableinfo, little endian was chosen
-    by default.
-    
-    Parameters:
-    - ``tableinfo``: Contains row structure, should be loaded from .json file.
+_TYPES = {'s8': 'b', 'u8': 'B', 's16': 'h', 'u16': 'H', 's32': 'i',
+    'u32': 'I', 's64': 'q', 'u64': 'Q', 'f32': 'f', 'str': 'I',
+    'ptr': 'I', 'bit8': 'B', 'bit16': 'H', 'bit32': 'I', 'bit64': 'Q',
+    'enum8': 'B', 'enum16': 'H'}
+
+
+def compileschema(tableinfo):
+    """Resolve the row structure of a table.
+
+    Return a tuple of (column names, struct format string, column info). \
+    Column info has one item per unpacked value, with gaps filled in.
     """
-    # Get column names and struct string
     columns = []
-    types = {'s8': 'b', 'u8': 'B', 's16': 'h', 'u16': 'H', 's32': 'i',
-        'u32': 'I', 's64': 'q', 'u64': 'Q', 'f32': 'f', 'str': 'I',
-        'ptr': 'I', 'bit8': 'B', 'bit16': 'H', 'bit32': 'I', 'bit64': 'Q',
-        'enum8': 'B', 'enum16': 'H'}
     gapstart = 0
     newtableinfo = []
     try:
@@ -146,7 +827,7 @@ def newrowclass(tableinfo):
         else:
             columns.append(column['name'])
         newtableinfo.append(column)
-        structchr = types[column['type']]
+        structchr = _TYPES[column['type']]
         gapstart = column['offset'] + calcsize(structchr)
         structstr += structchr
     if gapstart < tableinfo['row_length']:
@@ -156,19 +837,217 @@ def newrowclass(tableinfo):
         newtableinfo.append(OrderedDict([
             ('type', 'gap')
         ]))
+    return columns, structstr, newtableinfo
+
+
+def _enummap(enum):
+    """Return enum map keyed by int if possible, and the key function."""
+    try:
+        return dict((int(key), value) for key, value in enum.items()), ''
+    except ValueError:
+        return enum, 'format'
+
+
+def _generate(newtableinfo):
+    """Generate source code of specialized feed, totext, toraw and tobytes.
+
+    Return a tuple of (source code, namespace).
+    """
+    namespace = {'hexlify': hexlify}
+    raws = ['r{}'.format(i) for i in range(len(newtableinfo))]
+    strings = []  # Raw values which are string offsets
+    values = []  # Expressions of row values from raw values
+    words = []  # Expressions of totext words from row values
+    specs = []  # Format specs of totext words
+    packed = []  # Expressions of packed values from row values
+    hooked = []  # Same as `packed`, with string offsets from a hook
+    for raw, info in zip(raws, newtableinfo):
+        index = len(values)
+        row_value = 'self[{}]'.format(index)
+        if info['type'] == 'str':
+            strings.append(raw)
+            values.append(raw)
+            words.append(row_value)
+            specs.append(info['format'])
+            packed.append(row_value)
+            hooked.append('get_offset_hook({})'.format(row_value))
+            continue
+        elif info['type'].startswith('bit'):
+            values.append(raw)
+            bitdata = row_value
+            full_mask = (1 << int(info['type'][3:])) - 1
+            for bitcolumn in info['columns']:
+                mask = (1 << bitcolumn['length']) - 1
+                values.append('({} >> {}) & {}'.format(
+                    raw, bitcolumn['offset'], mask))
+                words.append('self[{}]'.format(len(values) - 1))
+                specs.append(bitcolumn['format'])
+                bitdata = '(({}) & {}) | ((self[{}] & {}) << {})'.format(
+                    bitdata, full_mask ^ (mask << bitcolumn['offset']),
+                    len(values) - 1, mask, bitcolumn['offset'])
+            packed.append(bitdata)
+        elif info['type'].startswith('enum'):
+            enum, keyfunction = _enummap(info['enum'])
+            namespace['e' + raw] = enum
+            namespace['v' + raw] = dict(
+                (value, key) for key, value in enum.items())
+            values.append('e{}[{}({})]'.format(raw, keyfunction, raw))
+            words.append(row_value)
+            specs.append(info['format'])
+            packed.append('v{}[{}]'.format(raw, row_value))
+        elif info['type'] == 'gap':
+            values.append(raw)
+            words.append("hexlify({}).decode('ascii')".format(row_value))
+            specs.append('')
+            packed.append(row_value)
+        else:
+            values.append(raw)
+            words.append(row_value)
+            specs.append(info['format'])
+            packed.append(row_value)
+        hooked.append(packed[-1])
+
+    namespace['template'] = '\t'.join(
+        '{{{}:{}}}'.format(i, spec) for i, spec in enumerate(specs))
+    lines = [
+        'def feed(cls, bytes_obj, get_string_hook=None):',
+        '    {}, = unpack(bytes_obj)'.format(', '.join(raws)),
+    ]
+    if strings:
+        lines.append('    if get_string_hook is not None:')
+        lines.extend('        {0} = get_string_hook({0})'.format(raw)
+                     for raw in strings)
+    lines.extend([
+        '    return new(cls, ({},))'.format(', '.join(values)),
+        '',
+        'def totext(self):',
+        '    return template.format({})'.format(', '.join(words)),
+        '',
+        'def toraw(self, get_offset_hook=None):',
+        '    if get_offset_hook is None:',
+        '        return ({},)'.format(', '.join(packed)),
+        '    return ({},)'.format(', '.join(hooked)),
+        '',
+        'def tobytes(self):',
+        '    return pack({})'.format(', '.join(packed)),
+    ])
+    return '\n'.join(lines) + '\n', namespace
+
+
+def compilerow(tableinfo):
+    """Resolve the row structure and generate the row methods of a table.
+
+    The result can be pickled, and given to `newrowclass` later.
+    """
+    columns, structstr, newtableinfo = compileschema(tableinfo)
+    source, namespace = _generate(newtableinfo)
+    return columns, structstr, newtableinfo, source, namespace
+
+
+def newrowclass(tableinfo, name=None, compiled=None):
+    """Create a new row class.
+
+    If no 'endianess' key was found in tableinfo, little endian was chosen
+    by default.
+
+    The `feed`, `totext`, `toraw` and `tobytes` methods of the row class are \
+    generated for the row structure, so that they do not look up column \
+    types for every row. Row classes are cached by `name`.
+    
+    Parameters:
+    - ``tableinfo``: Contains row structure, should be loaded from .json file.
+    - ``name``: Table name. If None, the row class is not cached.
+    - ``compiled``: Result of `compilerow` for ``tableinfo``, if available.
+    """
+    if name is not None and name in _rowclasses:
+        return _rowclasses[name]
+
+    # Get column names and struct string
+    if compiled is None:
+        compiled = compilerow(tableinfo)
+    columns, structstr, newtableinfo, source, namespace = compiled
+    struct_obj = Struct(structstr)
 
     Row = namedtuple('Row', columns)
     Row.columns = newtableinfo
-    Row.struct_obj = Struct(structstr)
-    Row.feed = classmethod(feed)
-    Row.totext = totext
-    Row.tobytes = tobytes
+    Row.struct_obj = struct_obj
 
-    print(columns)
-    print(structstr)
+    namespace = dict(namespace)
+    namespace.update(unpack=struct_obj.unpack, pack=struct_obj.pack,
+                     new=tuple.__new__)
+    exec(compile(source, '<Row {}>'.format(name), 'exec'), namespace)
+    Row.source = source
+    Row.feed = classmethod(namespace['feed'])
+    Row.totext = namespace['totext']
+    Row.toraw = namespace['toraw']
+    Row.tobytes = namespace['tobytes']
 
+    if name is not None:
+        _rowclasses[name] = Row
     return Row
 
 
+# Row structure used by benchmarks and tests
+SAMPLE_TABLEINFO = OrderedDict([
+    ('row_length', 24),
+    ('columns', [
+        OrderedDict([('name', 'id'), ('type', 'u16'), ('offset', 0),
+                     ('format', '')]),
+        OrderedDict([('name', 'name'), ('type', 'str'), ('offset', 4),
+                     ('format', '')]),
+        OrderedDict([('name', 'flags'), ('type', 'bit16'), ('offset', 8),
+                     ('format', '04X'), ('columns', [
+            OrderedDict([('name', 'a'), ('offset', 0), ('length', 3),
+                         ('format', '')]),
+            OrderedDict([('name', 'b'), ('offset', 3), ('length', 5),
+                         ('format', '')]),
+            OrderedDict([('name', 'c'), ('offset', 12), ('length', 4),
+                         ('format', '')]),
+        ])]),
+        OrderedDict([('name', 'kind'), ('type', 'enum8'), ('offset', 10),
+                     ('format', ''), ('enum', OrderedDict([
+            ('0', 'Weapon'), ('1', 'Armor'), ('2', 'Tool')]))]),
+        OrderedDict([('name', 'price'), ('type', 's32'), ('offset', 12),
+                     ('format', '')]),
+        OrderedDict([('name', 'stat'), ('type', 'f32'), ('offset', 16),
+                     ('format', '.2f')]),
+    ])
+])
+
+
+def benchmark(row_count=20000):
+    """Compare generic and generated row methods. Print rows per second."""
+    import random
+    from timeit import default_timer
+    Row = newrowclass(SAMPLE_TABLEINFO)
+    rng = random.Random(0)
+    rows = [Row.struct_obj.pack(i, b'\0\0', i, rng.randint(0, 0xFFFF),
+                                rng.randint(0, 2), b'\0',
+                                rng.randint(-100, 100000), rng.random(),
+                                b'\0' * 4)
+            for i in range(row_count)]
+    hook = 'S{}'.format
+
+    def run(label, function, items):
+        start = default_timer()
+        for item in items:
+            function(item)
+        print('{:16}{:12.0f} rows/s'.format(
+            label, len(items) / (default_timer() - start)))
+
+    generic = [feed(Row, bytes_obj, get_string_hook=hook) for bytes_obj in rows]
+    generated = [Row.feed(bytes_obj, get_string_hook=hook) for bytes_obj in rows]
+    assert generic == generated
+    assert [totext(row) for row in generic] == \
+        [row.totext() for row in generated]
+    run('feed (generic)', lambda b: feed(Row, b, get_string_hook=hook), rows)
+    run('feed', lambda b: Row.feed(b, get_string_hook=hook), rows)
+    run('totext (generic)', totext, generic)
+    run('totext', Row.totext, generated)
+    raws = [Row.feed(bytes_obj) for bytes_obj in rows]
+    assert [row.tobytes() for row in raws] == rows
+    run('tobytes', Row.tobytes, raws)
+
+
 if __name__ == '__main__':
-    pass
+    benchmark()